@@ -1,32 +1,68 @@
-import asyncio
+import atexit
+import io
 import json
 import os
+import queue
+import shlex
 import subprocess
+import threading
 import logging
-import pymorphy3
+import re
 import time
 import urllib3
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram import Update, BotCommand, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import InvalidToken
 from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
     Filters,
     CallbackContext,
 )
-from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta, timezone
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain
 import xml.etree.ElementTree as ET
 import requests
 
+try:
+    import orjson
+except ImportError:  # orjson не установлен — используется стандартный json
+    orjson = None
+
+try:
+    import git
+except ImportError:  # GitPython не установлен — синхронизация через git CLI
+    git = None
+
+try:
+    import magic
+except ImportError:  # python-magic не установлен — проверяется только заявленный mime_type
+    magic = None
+
 # Максимальная длина текста кнопки (в символах) для выравнивания
 MAX_BUTTON_TEXT_LENGTH = 100
 MAX_MEDIA_PER_ALBUM = 10  # Лимит Telegram API для sendMediaGroup
 
+# Морфологический анализатор создаётся один раз при первом поиске: конструктор
+# загружает словари, и бот без поисков не тратит на них память.
+# result_type=None — разборы возвращаются кортежами без обёртки Parse
+MORPH = None
+MORPH_LOCK = threading.Lock()
+MORPH_NORMAL_FORM = 2  # индекс нормальной формы в кортеже разбора
+TOKEN_RE = re.compile(r"[а-яa-z0-9]+")  # применяется к тексту после casefold() и YO_FOLD
+# "ё" и "е" в поиске не различаются: pymorphy3 восстанавливает "ё" в нормальной
+# форме, а незнакомые словарю слова остаются в том написании, в каком их ввели
+YO_FOLD = str.maketrans('ё', 'е')
+
 
 # Настройка логирования
 logging.basicConfig(
@@ -46,6 +82,24 @@ DADATA_TOKEN = os.getenv("DADATA_TOKEN")
 INN_CACHE = {}
 INN_TTL = 24 * 3600  # 1 день
 
+# Журнал действий пользователей: ограниченная очередь в bot_data,
+# новые записи периодически дописываются в USER_ACTIONS_FILE (с ротацией по размеру)
+MAX_USER_ACTIONS = 10_000
+USER_ACTIONS_FILE = 'user_actions.jsonl'
+USER_ACTIONS_FLUSH_INTERVAL = 300  # 5 минут
+USER_ACTIONS_MAX_BYTES = 10 * 1024 * 1024
+USER_ACTIONS_BACKUPS = 4
+
+USER_ACTIONS_LOCK = threading.Lock()
+
+CONVERSATION_TIMEOUT = timedelta(minutes=15)  # бездействие, после которого диалог сбрасывается
+CLEAR_CHAT_RATE = 25  # удалений в секунду при очистке чата
+MESSAGE_DELETE_MAX_AGE = 48 * 3600  # бот может удалять сообщения не старше 48 часов
+
+# Администраторы (доступ к /stats) и чат, куда отправляется статистика
+ADMIN_IDS = frozenset({1250098712})
+STATS_CHAT_ID = 1250098712
+
 # состояние ConversationHandler для ввода ИНН
 STATE_INN = 1
 
@@ -74,17 +128,195 @@ MAIN_MENU = ReplyKeyboardMarkup(
     one_time_keyboard=False
 )
 
-# Чтение JSON
+# Кнопки главного меню (шаблоны компилируются один раз при импорте)
+ADD_POINT_BUTTON_RE = re.compile(r'^➕ Добавить пункт$')
+EDIT_POINT_BUTTON_RE = re.compile(r'^✏️ Редактировать пункт$')
+MENU_BUTTONS_RE = re.compile(r'^(📖 Справочник|📋 Шаблоны ответов|➕ Добавить пункт|✏️ Редактировать пункт)$')
+
+# Допустимые типы документов: .doc, .docx, .pdf, .xls, .xlsx
+ALLOWED_DOC_MIMES = frozenset({
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/pdf',
+    'application/vnd.ms-excel',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+})
+MAX_DOC_BYTES = 20 * 1024 * 1024  # лимит Bot API на скачивание файла
+# По первым байтам libmagic не всегда отличает docx/xlsx от zip и doc/xls от OLE-контейнера
+SNIFFED_DOC_MIMES = ALLOWED_DOC_MIMES | {
+    'application/zip',
+    'application/x-ole-storage',
+    'application/CDFV2',
+    'application/vnd.ms-office',
+}
+SNIFF_BYTES = 4096
+SNIFF_TIMEOUT = 3  # проверка идёт в потоке диалога: дольше ждать нельзя, файл просто не проверяется
+MAGIC = None
+MAGIC_LOCK = threading.Lock()  # libmagic не потокобезопасен
+
+# Клавиатуры диалогов добавления и редактирования (создаются один раз)
+DONE_CANCEL_MENU = ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True)
+CANCEL_MENU = ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True)
+
+# Постоянные inline-клавиатуры (создаются один раз)
+EMPTY_TEMPLATES_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить шаблон", callback_data='add_template')],
+    [InlineKeyboardButton("🚪 Вернуться в меню", callback_data='cancel_template')]
+])
+DELETE_ANSWER_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🗑 Удалить", callback_data='delete_answer')]])
+
+# Короткие callback_data справочника и шаблонов: 'g42'/'t42' — пункт с ID 42,
+# 'Pg3'/'Pt3' — страница 3. Первая буква типа данных -> тип данных
+CALLBACK_DATA_TYPES = {'g': 'guide', 't': 'template'}
+
+# callback_data диалога редактирования: 'edit_guide_page_2', 'edit_template_question_42',
+# 'edit_guide_field_answer', 'cancel_template_edit' -> (действие, тип данных, вид, аргумент)
+EDIT_CALLBACK_RE = re.compile(r'^(edit|cancel)_(guide|template)_(page|question|field|edit)_?(.*)$')
+
+# JSON через orjson (кодирование на C), если он установлен
+def json_loads(raw: bytes):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def json_dumps(data, indent: bool = False) -> bytes:
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# Кэш разобранных JSON файлов: имя файла -> ((st_mtime_ns, st_size), данные).
+# Размер в ключе ловит перезапись файла снаружи в пределах разрешения mtime
+JSON_CACHE = {}
+
+def file_stamp(file_name: str):
+    try:
+        st = os.stat(file_name)
+    except FileNotFoundError:
+        return None  # файл ещё не создан, но может ждать отложенной записи
+    return (st.st_mtime_ns, st.st_size)
+
+# Чтение JSON (с кэшированием до изменения файла на диске)
 def load_data(data_type: str):
     file_name = 'guide.json' if data_type == 'guide' else 'templates.json'
+    key = 'questions' if data_type == 'guide' else 'templates'
     try:
-        with open(file_name, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            key = 'questions' if data_type == 'guide' else 'templates'
-            return data if key in data else {key: []}
+        stamp = file_stamp(file_name)
+        cached = JSON_CACHE.get(file_name)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        if stamp is None:
+            raise FileNotFoundError(file_name)
+        with open(file_name, 'rb') as f:
+            data = json_loads(f.read())
+        if key not in data:
+            data = {key: []}
+        JSON_CACHE[file_name] = (stamp, data)
+        logger.debug(f"{file_name} перечитан с диска")
+        return data
     except FileNotFoundError:
+        JSON_CACHE.pop(file_name, None)
         logger.warning(f"{file_name} не найден, инициализация пустого {data_type}")
-        return {"questions" if data_type == 'guide' else "templates": []}
+        return {key: []}
+
+# Индексы id -> пункт для кэшированных данных: имя файла -> (данные, индекс)
+ID_INDEX = {}
+
+def get_id_index(data_type: str, data):
+    file_name = 'guide.json' if data_type == 'guide' else 'templates.json'
+    key = 'questions' if data_type == 'guide' else 'templates'
+    entry = ID_INDEX.get(file_name)
+    if entry and entry[0] is data:
+        return entry[1]
+    index = {item['id']: item for item in data[key] if isinstance(item, dict) and 'id' in item}
+    cached = JSON_CACHE.get(file_name)
+    if cached and cached[1] is data:
+        ID_INDEX[file_name] = (data, index)
+    return index
+
+# Кэш клавиатур страниц для кэшированных данных: имя файла -> (данные, {страница: разметка})
+KEYBOARD_CACHE = {}
+
+def get_page_keyboard(data_type: str, data, page: int, build):
+    file_name = 'guide.json' if data_type == 'guide' else 'templates.json'
+    cached = JSON_CACHE.get(file_name)
+    if not (cached and cached[1] is data):
+        # Результаты поиска и прочие временные выборки не кэшируются
+        return build()
+    entry = KEYBOARD_CACHE.get(file_name)
+    if not entry or entry[0] is not data:
+        entry = (data, {})
+        KEYBOARD_CACHE[file_name] = entry
+    markup = entry[1].get(page)
+    if markup is None:
+        markup = entry[1][page] = build()
+    return markup
+
+# Поиск по кэшированному справочнику: имя файла -> (данные, функция поиска).
+# Функция поиска держит снимок списка пунктов, обратный индекс {нормальная форма: позиции
+# в снимке} и LRU-кэш результатов; при сохранении данных выбрасывается вместе с индексом.
+# Снимок нужен потому, что удаление пункта сдвигает исходный список раньше, чем save_data
+# сбросит индекс, а поиск в это время может выполняться в другом потоке
+SEARCH_INDEX = {}
+SEARCH_RESULTS_CACHE_SIZE = 256
+EMPTY_POSTINGS = frozenset()
+MIN_SEARCH_LENGTH = 2
+
+def get_morph():
+    global MORPH
+    if MORPH is None:
+        with MORPH_LOCK:
+            if MORPH is None:
+                import pymorphy3
+                MORPH = pymorphy3.MorphAnalyzer(result_type=None)
+    return MORPH
+
+@lru_cache(maxsize=200_000)
+def normal_form(word: str) -> str:
+    return get_morph().parse(word)[0][MORPH_NORMAL_FORM].translate(YO_FOLD)
+
+def normalize_words(text: str) -> set:
+    return {normal_form(word) for word in TOKEN_RE.findall(text.casefold().translate(YO_FOLD))}
+
+# Слова пункта кэшируются по тексту вопроса и ответа: после сохранения
+# индекс перестраивается, но заново разбираются только изменённые пункты
+@lru_cache(maxsize=4096)
+def item_words(question: str, answer: str) -> frozenset:
+    words = normalize_words(question)
+    if answer:
+        words |= normalize_words(answer)
+    return frozenset(words)
+
+def find_positions(postings: dict, keyword_words: frozenset) -> tuple:
+    # Пересечение начинается с самого редкого слова и прерывается, как только стало пустым
+    word_sets = sorted((postings.get(word, EMPTY_POSTINGS) for word in keyword_words), key=len)
+    positions = set(word_sets[0])
+    for word_set in word_sets[1:]:
+        if not positions:
+            break
+        positions &= word_set
+    return tuple(sorted(positions))
+
+def find_items(questions: tuple, postings: dict, keyword_words: frozenset) -> tuple:
+    return tuple(questions[pos] for pos in find_positions(postings, keyword_words))
+
+def get_guide_search(guide):
+    entry = SEARCH_INDEX.get('guide.json')
+    if entry and entry[0] is guide:
+        return entry[1]
+    questions = tuple(guide["questions"])
+    postings = defaultdict(set)
+    for pos, q in enumerate(questions):
+        if not (isinstance(q, dict) and "id" in q and "question" in q and isinstance(q["question"], str)):
+            continue
+        answer = q.get("answer") if isinstance(q.get("answer"), str) else ""
+        for word in item_words(q["question"], answer):
+            postings[word].add(pos)
+    search = lru_cache(maxsize=SEARCH_RESULTS_CACHE_SIZE)(partial(find_items, questions, dict(postings)))
+    cached = JSON_CACHE.get('guide.json')
+    if cached and cached[1] is guide:
+        SEARCH_INDEX['guide.json'] = (guide, search)
+        logger.debug(f"Индекс поиска перестроен: {len(postings)} слов")
+    return search
 
 def load_guide():
     return load_data('guide')
@@ -103,26 +335,98 @@ def load_fz_texts(fz_type: str):
         return ''
 
 # Чтение user_id из переменной окружения
-def load_users():
+def load_users() -> frozenset:
     users_str = os.getenv("ALLOWED_USERS", "")
     logger.info(f"Raw ALLOWED_USERS: '{users_str}'")
     if not users_str:
         logger.warning("ALLOWED_USERS пуст")
-        return []
+        return frozenset()
     try:
-        users = [int(user_id) for user_id in users_str.split(",") if user_id.strip()]
-        logger.info(f"Загружены разрешенные пользователи: {users}")
+        users = frozenset(int(user_id) for user_id in users_str.split(",") if user_id.strip())
+        logger.info(f"Загружены разрешенные пользователи: {sorted(users)}")
         return users
     except ValueError as e:
         logger.error(f"Ошибка парсинга ALLOWED_USERS: {e}")
-        return []
+        return frozenset()
+
+# Переменная окружения не меняется во время работы: разбираем один раз при запуске
+ALLOWED_USERS = load_users()
 
 # Сохранение JSON и синхронизация с GitHub
+# Отложенная запись JSON: изменения сразу видны через JSON_CACHE, а на диск
+# файл пишется одним разом не раньше чем через SAVE_DELAY секунд
+SAVE_DELAY = 1
+SAVE_RETRY_DELAY = 30  # повтор записи, если диск вернул ошибку
+PENDING_SAVES = {}  # имя файла -> (тип данных, данные для записи)
+SAVE_TIMER = None
+SAVE_LOCK = threading.Lock()
+WRITE_LOCK = threading.Lock()  # один писатель: таймер и atexit не пишут .tmp одновременно
+
 def save_data(data_type: str, data):
     file_name = 'guide.json' if data_type == 'guide' else 'templates.json'
-    with open(file_name, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    sync_with_github()
+    # Кэш сразу указывает на новые данные; отметка файла обновится после записи на диск
+    JSON_CACHE[file_name] = (file_stamp(file_name), data)
+    ID_INDEX.pop(file_name, None)
+    KEYBOARD_CACHE.pop(file_name, None)
+    SEARCH_INDEX.pop(file_name, None)
+    queue_save(file_name, data_type, data, SAVE_DELAY)
+
+def queue_save(file_name: str, data_type: str, data, delay: float, retry: bool = False):
+    global SAVE_TIMER
+    with SAVE_LOCK:
+        # Повтор не затирает более новые данные, сохранённые после неудачной записи
+        if not (retry and file_name in PENDING_SAVES):
+            PENDING_SAVES[file_name] = (data_type, data)
+        if SAVE_TIMER is None:
+            SAVE_TIMER = threading.Timer(delay, flush_pending_saves)
+            SAVE_TIMER.daemon = True
+            SAVE_TIMER.start()
+
+JSON_WRITE_BUFFER = 64 * 1024
+
+def write_json_file(file_name: str, data):
+    # Запись во временный файл и атомарная замена: файл никогда не остаётся записанным наполовину
+    tmp_name = file_name + '.tmp'
+    # Формат совпадает с json.dump(ensure_ascii=False, indent=2) и при записи через orjson
+    with open(tmp_name, 'wb', buffering=JSON_WRITE_BUFFER) as f:
+        f.write(json_dumps(data, indent=True))
+        f.flush()
+        # Данные на диске до переименования: после сбоя питания не останется пустого guide.json
+        os.fsync(f.fileno())
+    os.replace(tmp_name, file_name)
+
+def flush_pending_saves(sync: bool = True):
+    global SAVE_TIMER
+    with SAVE_LOCK:
+        pending = dict(PENDING_SAVES)
+        PENDING_SAVES.clear()
+        if SAVE_TIMER is not None:
+            SAVE_TIMER.cancel()
+            SAVE_TIMER = None
+    if not pending:
+        return []
+    written = []
+    with WRITE_LOCK:
+        for file_name, (data_type, data) in pending.items():
+            try:
+                write_json_file(file_name, data)
+            except OSError as e:
+                # Пользователь уже получил "сохранено", а изменения пока есть только в памяти
+                if sync:
+                    logger.error(f"Ошибка записи {file_name}, изменения только в памяти, повтор через {SAVE_RETRY_DELAY} с: {e}")
+                    queue_save(file_name, data_type, data, SAVE_RETRY_DELAY, retry=True)
+                else:
+                    logger.critical(f"Ошибка записи {file_name} при остановке, изменения потеряны: {e}")
+                continue
+            cached = JSON_CACHE.get(file_name)
+            if cached and cached[1] is data:
+                JSON_CACHE[file_name] = (file_stamp(file_name), data)
+            written.append(data_type)
+            logger.debug(f"{file_name} записан на диск")
+    if sync:
+        for data_type in written:
+            schedule_github_sync(data_type)
+    return written
 
 def save_guide(data):
     save_data('guide', data)
@@ -130,29 +434,150 @@ def save_guide(data):
 def save_templates(data):
     save_data('template', data)
 
+# Отложенная синхронизация с GitHub: сохранения кладутся в очередь, один фоновый поток
+# ждёт паузы в GIT_SYNC_DELAY секунд и отправляет всю серию одним коммитом.
+# Синхронизации выполняются строго по очереди и не пересекаются между собой
+GIT_SYNC_DELAY = 5
+GIT_SYNC_Q = queue.SimpleQueue()
+GIT_SYNC_LOCK = threading.Lock()
+GIT_RUN_LOCK = threading.Lock()  # фоновый поток и atexit не запускают git одновременно
+# Есть сохранённые, но ещё не отправленные изменения JSON (вместо git status)
+GIT_DIRTY = False
+
+def schedule_github_sync(data_type: str = None):
+    mark_git_dirty()
+    GIT_SYNC_Q.put(data_type)
+    logger.debug("Синхронизация с GitHub запланирована через %s с", GIT_SYNC_DELAY)
+
+def git_sync_worker():
+    while True:
+        data_types = {GIT_SYNC_Q.get()}
+        # Пока сохранения продолжают приходить, откладываем синхронизацию
+        while True:
+            try:
+                data_types.add(GIT_SYNC_Q.get(timeout=GIT_SYNC_DELAY))
+            except queue.Empty:
+                break
+        with GIT_RUN_LOCK:
+            sync_with_github(data_types.pop() if len(data_types) == 1 else None)
+
+def drain_git_sync_queue() -> set:
+    data_types = set()
+    while True:
+        try:
+            data_types.add(GIT_SYNC_Q.get_nowait())
+        except queue.Empty:
+            return data_types
+
+# При остановке бота дописываем отложенные изменения и сразу отправляем их в git:
+# поток синхронизации фоновый и не дождался бы паузы GIT_SYNC_DELAY, а GIT_DIRTY
+# хранится только в памяти и после перезапуска был бы потерян
+def flush_on_exit():
+    written = flush_pending_saves(sync=False)
+    if written:
+        mark_git_dirty()
+    data_types = drain_git_sync_queue() | set(written)
+    if not GIT_DIRTY:
+        return
+    with GIT_RUN_LOCK:
+        sync_with_github(data_types.pop() if len(data_types) == 1 else None)
+
+atexit.register(flush_on_exit)
+
+def take_git_dirty() -> bool:
+    global GIT_DIRTY
+    with GIT_SYNC_LOCK:
+        dirty, GIT_DIRTY = GIT_DIRTY, False
+    return dirty
+
+def mark_git_dirty():
+    global GIT_DIRTY
+    with GIT_SYNC_LOCK:
+        GIT_DIRTY = True
+
+def run_git_script(script: str):
+    return subprocess.run(script, shell=True, executable="/bin/bash", capture_output=True, text=True)
+
+# Репозиторий открывается один раз и переиспользуется всеми синхронизациями
+GIT_REPO = None
+
+def get_git_repo():
+    global GIT_REPO
+    if git is None:
+        return None
+    if GIT_REPO is None:
+        try:
+            GIT_REPO = git.Repo('.')
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError) as e:
+            logger.error(f"Не удалось открыть git-репозиторий: {e}")
+            return None
+    return GIT_REPO
+
 def sync_with_github(data_type: str = None):
+    if not take_git_dirty():
+        logger.info("Нет изменений в рабочей директории для коммита")
+        return
+    if data_type:
+        file_name = 'guide.json' if data_type == 'guide' else 'templates.json'
+        commit_message = f"Обновление {file_name} через бот"
+    else:
+        commit_message = "Обновление JSON файлов через бот"
+    repo = get_git_repo()
+    if repo is None:
+        sync_with_github_cli(commit_message, data_type)
+        return
     try:
-        result = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True)
-        if not result.stdout:
-            logger.info("Нет изменений в рабочей директории для коммита")
-            return
-        subprocess.run(["git", "add", "."], check=True)
-        commit_message = f"Обновление {data_type}.json через бот" if data_type else "Обновление JSON файлов через бот"
-        subprocess.run(["git", "commit", "-m", commit_message], check=True)
-        subprocess.run(["git", "pull", "--rebase"], check=True)
-        subprocess.run(["git", "push", "origin", "main"], check=True)
-        logger.info(f"Успешно синхронизированы JSON файлы с GitHub ({data_type or 'все файлы'})")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Ошибка синхронизации с Git: {e}")
+        repo.git.add('.')
+        # При повторной попытке после ошибки push коммит уже может быть создан
+        if repo.index.write_tree() != repo.head.commit.tree:
+            repo.index.commit(commit_message)
+        origin = repo.remotes.origin
         try:
-            subprocess.run(["git", "rebase", "--abort"], check=True)
-            subprocess.run(["git", "pull", "--no-rebase"], check=True)
-            subprocess.run(["git", "push", "origin", "main"], check=True)
+            origin.pull(rebase=True)
+            origin.push('main')
+            logger.info(f"Успешно синхронизированы JSON файлы с GitHub ({data_type or 'все файлы'})")
+        except git.GitCommandError as e:
+            logger.error(f"Ошибка синхронизации с Git: {e}")
+            try:
+                try:
+                    repo.git.rebase('--abort')
+                except git.GitCommandError:
+                    pass
+                origin.pull(rebase=False)
+                origin.push('main')
+                logger.info("Разрешен конфликт git и синхронизированы JSON файлы")
+            except git.GitCommandError as e2:
+                logger.error(f"Не удалось разрешить конфликт git: {e2}")
+                mark_git_dirty()
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при синхронизации с git: {e}")
+        mark_git_dirty()
+
+def sync_with_github_cli(commit_message: str, data_type: str = None):
+    try:
+        # add/commit/pull/push одним вызовом оболочки вместо четырёх процессов
+        result = run_git_script(
+            f"git add . && git commit -m {shlex.quote(commit_message)} && git pull --rebase && git push origin main"
+        )
+        if result.returncode == 0:
+            logger.info(f"Успешно синхронизированы JSON файлы с GitHub ({data_type or 'все файлы'})")
+            return
+        logger.error(f"Ошибка синхронизации с Git (код {result.returncode}): {result.stderr.strip()}")
+        result = run_git_script("git rebase --abort; git pull --no-rebase && git push origin main")
+        if result.returncode == 0:
             logger.info("Разрешен конфликт git и синхронизированы JSON файлы")
-        except subprocess.CalledProcessError as e2:
-            logger.error(f"Не удалось разрешить конфликт git: {e2}")
+        else:
+            logger.error(f"Не удалось разрешить конфликт git: {result.stderr.strip()}")
+            mark_git_dirty()
     except Exception as e:
         logger.error(f"Неожиданная ошибка при синхронизации с git: {e}")
+        mark_git_dirty()
+
+# Имя пользователя для журналов: username, имя и фамилия или "ID ...". Кэш отдаёт один
+# и тот же объект строки для повторных событий пользователя вместо новой строки на каждое
+@lru_cache(maxsize=4096)
+def user_display_name(user_id: int, username: str = None, first_name: str = None, last_name: str = None) -> str:
+    return username or f"{first_name or ''} {last_name or ''}".strip() or f"ID {user_id}"
 
 # Проверка доступа
 def restrict_access(func):
@@ -160,11 +585,9 @@ def restrict_access(func):
         user = update.effective_user
         user_id = user.id
         # Формируем имя пользователя для логов
-        user_display = user.username or f"{user.first_name or ''} {user.last_name or ''}".strip() or f"ID {user_id}"
-        logger.info(f"Проверка доступа для пользователя {user_display} (ID: {user_id})")
-        users = load_users()
-        logger.info(f"Разрешенные пользователи: {users}")
-        if user_id not in users:
+        user_display = user_display_name(user_id, user.username, user.first_name, user.last_name)
+        logger.debug("Проверка доступа для пользователя %s (ID: %s)", user_display, user_id)
+        if user_id not in ALLOWED_USERS:
             error_msg = "🚫 Доступ запрещён! Обратитесь к администратору."
             if update.message:
                 update.message.reply_text(error_msg, reply_markup=MAIN_MENU)
@@ -177,13 +600,82 @@ def restrict_access(func):
         return func(update, context, *args, **kwargs)
     return wrapper
 
+# Блокировки по chat_id: обработчики с run_async=True выполняются в пуле потоков,
+# и апдейты одного чата не должны обрабатываться параллельно. Набор блокировок
+# фиксированный (чат -> chat_id % CHAT_LOCK_STRIPES), поэтому не растёт с числом чатов;
+# разные чаты изредка делят блокировку и тогда просто ждут друг друга
+CHAT_LOCK_STRIPES = 64
+CHAT_LOCKS = tuple(threading.RLock() for _ in range(CHAT_LOCK_STRIPES))
+
+def serialize_per_chat(func):
+    def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        chat = update.effective_chat
+        if chat is None:
+            return func(update, context, *args, **kwargs)
+        with CHAT_LOCKS[chat.id % CHAT_LOCK_STRIPES]:
+            return func(update, context, *args, **kwargs)
+    return wrapper
+
+# Журнал действий: обработчики только кладут запись в очередь,
+# форматирование времени и добавление в user_actions выполняет фоновый поток
+ACTION_Q = queue.SimpleQueue()
+
+def record_action(context: CallbackContext, user, action: str, details: str):
+    ACTION_Q.put((context.bot_data, user.id, user_display_name(user.id, user.username), action, time.time_ns(), details))
+
+def log_action(action: str, details: str):
+    def decorator(func):
+        def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+            record_action(context, update.effective_user, action, details)
+            return func(update, context, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def drain_user_actions():
+    # ISO-строка пересчитывается только при смене секунды: действия пачкой приходят в одну секунду
+    last_epoch, last_iso = None, ''
+    while True:
+        bot_data, user_id, username, action, ts_ns, details = ACTION_Q.get()
+        try:
+            actions = bot_data.get('user_actions')
+            if actions is None:
+                actions = bot_data['user_actions'] = deque(maxlen=MAX_USER_ACTIONS)
+            ts_epoch = ts_ns // 1_000_000_000
+            if ts_epoch != last_epoch:
+                last_epoch, last_iso = ts_epoch, datetime.fromtimestamp(ts_epoch, timezone.utc).isoformat()
+            actions.append({
+                'user_id': user_id,
+                'username': username,
+                'action': action,
+                # Для журнала достаточно точности до секунды: строка короче и быстрее форматируется
+                'timestamp': last_iso,
+                'ts_epoch': ts_epoch,  # для сравнения по времени без разбора ISO-строки
+                'details': details
+            })
+        except Exception as e:
+            logger.error(f"Ошибка записи действия {action} пользователя {username}: {str(e)}")
+
+# Время действия в секундах epoch; у записей без ts_epoch (старый формат) разбираем ISO-строку
+def action_epoch(action) -> float:
+    ts_epoch = action.get('ts_epoch')
+    if ts_epoch is None:
+        ts_epoch = action['ts_epoch'] = datetime.fromisoformat(action['timestamp']).timestamp()
+    return ts_epoch
+
+# Сброс состояния пользователя: словарь очищается и заполняется одним update() вместо
+# поштучных присваиваний. Имя пользователя, записанное restrict_access, сохраняется
+def reset_user_data(user_data: dict, **values):
+    user_display = user_data.get('user_display')
+    user_data.clear()
+    if user_display is not None:
+        user_data['user_display'] = user_display
+    user_data.update(values)
+
 # Обработчик ошибок
 def error_handler(update: Update, context: CallbackContext):
     logger.error(f"Update {update} вызвал ошибку: {context.error}", exc_info=True)
     logger.info(f"Текущее состояние диалога: {context.user_data.get('conversation_state', 'NONE')}")
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'ERROR'
-    context.user_data['conversation_active'] = False
+    reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
     if update.message:
         update.message.reply_text(
             "❌ Произошла ошибка. Попробуйте снова или свяжитесь с администратором.",
@@ -199,30 +691,15 @@ def error_handler(update: Update, context: CallbackContext):
 
 # Команда /start
 @restrict_access
+@log_action('start', 'Пользователь запустил бота')
 def start(update: Update, context: CallbackContext):
     user = update.effective_user
-    user_display = context.user_data.get('user_display', f"ID {user.id}")
+    user_display = context.user_data.get('user_display') or user_display_name(user.id)
     logger.info(f"Пользователь {user_display} запустил бота")
     context.user_data['user_display'] = user_display
-    if 'user_actions' not in context.bot_data:
-        context.bot_data['user_actions'] = []
-    context.bot_data['user_actions'].append({
-        'user_id': user.id,
-        'username': user.username or f"ID {user.id}",
-        'action': 'start',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь запустил бота'
-    })
-    try:
-        update.message.delete()
-    except Exception as e:
-        logger.debug(f"Не удалось удалить сообщение /start от {user_display}: {e}")
-    context.job_queue.run_once(
-        lambda ctx: clear_chat(ctx, update.effective_chat.id, update.effective_message.message_id, user_display),
-        0,
-        context=None
-    )
-    context.user_data.clear()
+    delete_user_message(update.message, user_display, "сообщение /start")
+    context.dispatcher.run_async(clear_chat, context, update.effective_chat.id, update.effective_message.message_id, user_display)
+    reset_user_data(context.user_data)
     update.message.reply_text(
         "👋 Добро пожаловать в справочник-бот! Используйте меню для навигации.",
         reply_markup=MAIN_MENU
@@ -232,50 +709,49 @@ def start(update: Update, context: CallbackContext):
 # Команда /cancel
 @restrict_access
 def cancel(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     logger.info(f"Пользователь {user_display} отменил диалог")
     if context.user_data.get('timeout_task'):
         context.user_data['timeout_task'].cancel()
         context.user_data['timeout_task'] = None
         logger.info(f"Пользователь {user_display} отменил задачу таймаута")
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'CANCELLED'
-    context.user_data['conversation_active'] = False
+    reset_user_data(context.user_data, conversation_state='CANCELLED', conversation_active=False)
     update.message.reply_text(
         "🚪 Диалог отменён. Выберите действие:",
         reply_markup=MAIN_MENU
     )
     return ConversationHandler.END
 
+# Диалог брошен на середине: по истечении CONVERSATION_TIMEOUT освобождаем собранные
+# в user_data фото, документы и прочее состояние диалога
+def conversation_timeout(update: Update, context: CallbackContext):
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+    logger.info("Диалог пользователя %s завершён по таймауту", user_display)
+    if context.user_data.get('timeout_task'):
+        context.user_data['timeout_task'].schedule_removal()
+    reset_user_data(context.user_data, conversation_state='TIMEOUT', conversation_active=False)
+    if update.effective_chat:
+        context.bot.send_message(
+            update.effective_chat.id,
+            "⌛ Время ожидания истекло, действие отменено.",
+            reply_markup=MAIN_MENU
+        )
+
 # Открытие справочника
 @restrict_access
+@log_action('open_guide', 'Пользователь открыл справочник')
 def open_guide(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-    logger.info(f"Пользователь {user_display} открыл справочник")
-    # Запись действия с никнеймом
-    if 'user_actions' not in context.bot_data:
-        context.bot_data['user_actions'] = []
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",  # Сохраняем никнейм или ID
-        'action': 'open_guide',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь открыл справочник'
-    })
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+    logger.info("Пользователь %s открыл справочник", user_display)
     # Остальной код без изменений
-    try:
-        update.message.delete()
-    except Exception as e:
-        logger.debug(f"Не удалось удалить сообщение пользователя {user_display}: {e}")
-    context.job_queue.run_once(
-        lambda ctx: clear_chat(ctx, update.effective_chat.id, update.effective_message.message_id, user_display),
-        0,
-        context=None
+    delete_user_message(update.message, user_display)
+    context.dispatcher.run_async(clear_chat, context, update.effective_chat.id, update.effective_message.message_id, user_display)
+    reset_user_data(
+        context.user_data,
+        conversation_state='OPEN_GUIDE',
+        conversation_active=False,
+        data_type='guide'
     )
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'OPEN_GUIDE'
-    context.user_data['conversation_active'] = False
-    context.user_data['data_type'] = 'guide'
     guide = load_guide()
     if not guide["questions"]:
         update.message.reply_text(
@@ -288,28 +764,13 @@ def open_guide(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 @restrict_access
+@log_action('open_fz223_guide', 'Пользователь открыл справочник 223-ФЗ')
 def open_fz223_guide(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-    logger.info(f"Пользователь {user_display} открыл справочник 223-ФЗ")
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",
-        'action': 'open_fz223_guide',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь открыл справочник 223-ФЗ'
-    })
-    try:
-        update.message.delete()
-    except Exception as e:
-        logger.debug(f"Не удалось удалить сообщение пользователя {user_display}: {e}")
-    context.job_queue.run_once(
-        lambda ctx: clear_chat(ctx, update.effective_chat.id, update.effective_message.message_id, user_display),
-        0,
-        context=None
-    )
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'OPEN_FZ223_GUIDE'
-    context.user_data['conversation_active'] = False
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+    logger.info("Пользователь %s открыл справочник 223-ФЗ", user_display)
+    delete_user_message(update.message, user_display)
+    context.dispatcher.run_async(clear_chat, context, update.effective_chat.id, update.effective_message.message_id, user_display)
+    reset_user_data(context.user_data, conversation_state='OPEN_FZ223_GUIDE', conversation_active=False)
     fz_text = load_fz_texts('223')
     if not fz_text:
         update.message.reply_text(
@@ -330,28 +791,13 @@ def open_fz223_guide(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 @restrict_access
+@log_action('open_fz44_guide', 'Пользователь открыл справочник 44-ФЗ')
 def open_fz44_guide(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-    logger.info(f"Пользователь {user_display} открыл справочник 44-ФЗ")
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",
-        'action': 'open_fz44_guide',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь открыл справочник 44-ФЗ'
-    })
-    try:
-        update.message.delete()
-    except Exception as e:
-        logger.debug(f"Не удалось удалить сообщение пользователя {user_display}: {e}")
-    context.job_queue.run_once(
-        lambda ctx: clear_chat(ctx, update.effective_chat.id, update.effective_message.message_id, user_display),
-        0,
-        context=None
-    )
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'OPEN_FZ44_GUIDE'
-    context.user_data['conversation_active'] = False
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+    logger.info("Пользователь %s открыл справочник 44-ФЗ", user_display)
+    delete_user_message(update.message, user_display)
+    context.dispatcher.run_async(clear_chat, context, update.effective_chat.id, update.effective_message.message_id, user_display)
+    reset_user_data(context.user_data, conversation_state='OPEN_FZ44_GUIDE', conversation_active=False)
     fz_text = load_fz_texts('44')
     if not fz_text:
         update.message.reply_text(
@@ -373,41 +819,24 @@ def open_fz44_guide(update: Update, context: CallbackContext):
 
 # Открытие шаблонов
 @restrict_access
+@log_action('open_templates', 'Пользователь открыл шаблоны')
 def open_templates(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-    logger.info(f"Пользователь {user_display} открыл шаблоны")
-    # Запись действия с никнеймом
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",
-        'action': 'open_templates',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь открыл шаблоны'
-    })
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+    logger.info("Пользователь %s открыл шаблоны", user_display)
     # Остальной код без изменений
-    try:
-        update.message.delete()
-    except Exception as e:
-        logger.debug(f"Не удалось удалить сообщение пользователя {user_display}: {e}")
-    context.job_queue.run_once(
-        lambda ctx: clear_chat(ctx, update.effective_chat.id, update.effective_message.message_id, user_display),
-        0,
-        context=None
+    delete_user_message(update.message, user_display)
+    context.dispatcher.run_async(clear_chat, context, update.effective_chat.id, update.effective_message.message_id, user_display)
+    reset_user_data(
+        context.user_data,
+        conversation_state='OPEN_TEMPLATE',
+        conversation_active=False,
+        data_type='template'
     )
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'OPEN_TEMPLATE'
-    context.user_data['conversation_active'] = False
-    context.user_data['data_type'] = 'template'
     templates = load_templates()
     if not templates["templates"]:
-        keyboard = [
-            [InlineKeyboardButton("➕ Добавить шаблон", callback_data='add_template')],
-            [InlineKeyboardButton("🚪 Вернуться в меню", callback_data='cancel_template')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         update.message.reply_text(
             "📋 Шаблоны ответов пусты. Добавьте первый шаблон!",
-            reply_markup=reply_markup
+            reply_markup=EMPTY_TEMPLATES_MARKUP
         )
         return ConversationHandler.END
     page = context.user_data.get('page', 0)
@@ -416,6 +845,7 @@ def open_templates(update: Update, context: CallbackContext):
 
 # Отображение страницы справочника
 def display_guide_page(update: Update, context: CallbackContext, data, page, data_type: str):
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     try:
         ITEMS_PER_PAGE = 15
         total_items = len(data["questions"])
@@ -429,26 +859,25 @@ def display_guide_page(update: Update, context: CallbackContext, data, page, dat
         end_idx = min(start_idx + ITEMS_PER_PAGE, total_items)
         items = data["questions"][start_idx:end_idx]
 
-        keyboard = []
-        for item in items:
-            if not isinstance(item, dict) or "question" not in item or "id" not in item:
-                logger.error(f"Неверные данные справочника: {item}")
-                continue
-            question_text = item["question"][:50] if len(item["question"]) > 50 else item["question"]
-            padded_text = f"📄 {question_text}" + "." * (MAX_BUTTON_TEXT_LENGTH - len(f"📄 {question_text}"))
-            logger.debug(f"Сформирована кнопка справочника: '{padded_text}' (длина: {len(padded_text)})")
-            keyboard.append([InlineKeyboardButton(padded_text, callback_data=f'{data_type}_question_{item["id"]}')])
-
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'{data_type}_page_{page-1}'))
-        if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f'{data_type}_page_{page+1}'))
-        keyboard.append(nav_buttons)
-
-        inline_reply_markup = InlineKeyboardMarkup(keyboard)
+        def build_keyboard():
+            keyboard = []
+            for item in items:
+                if not isinstance(item, dict) or "question" not in item or "id" not in item:
+                    logger.error(f"Неверные данные справочника: {item}")
+                    continue
+                padded_text = f"📄 {item['question'][:50]}".ljust(MAX_BUTTON_TEXT_LENGTH, ".")
+                keyboard.append([InlineKeyboardButton(padded_text, callback_data=f'{data_type[0]}{item["id"]}')])
+
+            nav_buttons = []
+            if page > 0:
+                nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'P{data_type[0]}{page-1}'))
+            if page < total_pages - 1:
+                nav_buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f'P{data_type[0]}{page+1}'))
+            keyboard.append(nav_buttons)
+            return InlineKeyboardMarkup(keyboard)
+
+        inline_reply_markup = get_page_keyboard(data_type, data, page, build_keyboard)
         text = f"📖 Справочник (страница {page + 1}/{total_pages}):"
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
 
         if update.message:
             message = update.message.reply_text(
@@ -456,25 +885,19 @@ def display_guide_page(update: Update, context: CallbackContext, data, page, dat
                 reply_markup=inline_reply_markup,
                 reply_to_message_id=None
             )
+            context.user_data['page_message_id'] = message.message_id
             # Планируем автоудаление списка через 4 часа
             context.job_queue.run_once(
                 lambda ctx: clear_chat(ctx, update.effective_chat.id, message.message_id, user_display),
                 14400,
                 context=None
             )
-            # Отправляем сообщение с главным меню
-            menu_message = update.message.reply_text("Выберите нужный пункт", reply_markup=MAIN_MENU)
-            # Планируем автоудаление сообщения "Выберите нужный пункт" через 4 часа
-            context.job_queue.run_once(
-                lambda ctx: clear_chat(ctx, update.effective_chat.id, menu_message.message_id, user_display),
-                14400,
-                context=None
-            )
         elif update.callback_query:
             update.callback_query.message.edit_text(
                 text,
                 reply_markup=inline_reply_markup
             )
+            context.user_data['page_message_id'] = update.callback_query.message.message_id
             # Планируем автоудаление отредактированного сообщения через 4 часа
             context.job_queue.run_once(
                 lambda ctx: clear_chat(ctx, update.effective_chat.id, update.callback_query.message.message_id, user_display),
@@ -482,13 +905,12 @@ def display_guide_page(update: Update, context: CallbackContext, data, page, dat
                 context=None
             )
 
-        logger.info(f"Пользователь {user_display} просмотрел страницу справочника {page + 1}")
+        logger.debug("Пользователь %s просмотрел страницу справочника %s", user_display, page + 1)
         context.user_data['conversation_state'] = f'{data_type.upper()}_PAGE'
         context.user_data['conversation_active'] = False
         return ConversationHandler.END
 
     except Exception as e:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
         logger.error(f"Ошибка в display_guide_page для пользователя {user_display}: {str(e)}", exc_info=True)
         if update.message:
             update.message.reply_text(
@@ -504,6 +926,7 @@ def display_guide_page(update: Update, context: CallbackContext, data, page, dat
 
 # Отображение страницы шаблонов
 def display_template_page(update: Update, context: CallbackContext, data, page):
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     try:
         ITEMS_PER_PAGE = 15
         total_items = len(data["templates"])
@@ -517,31 +940,30 @@ def display_template_page(update: Update, context: CallbackContext, data, page):
         end_idx = min(start_idx + ITEMS_PER_PAGE, total_items)
         items = data["templates"][start_idx:end_idx]
 
-        keyboard = []
-        for item in items:
-            if not isinstance(item, dict) or "question" not in item or "id" not in item:
-                logger.error(f"Неверные данные шаблона: {item}")
-                continue
-            question_text = item["question"][:50] if len(item["question"]) > 50 else item["question"]
-            padded_text = f"📄 {question_text}" + "." * (MAX_BUTTON_TEXT_LENGTH - len(f"📄 {question_text}"))
-            logger.debug(f"Сформирована кнопка шаблона: '{padded_text}' (длина: {len(padded_text)})")
-            keyboard.append([InlineKeyboardButton(padded_text, callback_data=f'template_question_{item["id"]}')])
-
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'template_page_{page-1}'))
-        if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f'template_page_{page+1}'))
-        nav_buttons.extend([
-            InlineKeyboardButton("➕ Добавить шаблон", callback_data='add_template'),
-            InlineKeyboardButton("✏️ Редактировать шаблон", callback_data='edit_template'),
-            InlineKeyboardButton("🚪 Вернуться в меню", callback_data='cancel_template')
-        ])
-        keyboard.append(nav_buttons)
-
-        inline_reply_markup = InlineKeyboardMarkup(keyboard)
+        def build_keyboard():
+            keyboard = []
+            for item in items:
+                if not isinstance(item, dict) or "question" not in item or "id" not in item:
+                    logger.error(f"Неверные данные шаблона: {item}")
+                    continue
+                padded_text = f"📄 {item['question'][:50]}".ljust(MAX_BUTTON_TEXT_LENGTH, ".")
+                keyboard.append([InlineKeyboardButton(padded_text, callback_data=f't{item["id"]}')])
+
+            nav_buttons = []
+            if page > 0:
+                nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'Pt{page-1}'))
+            if page < total_pages - 1:
+                nav_buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f'Pt{page+1}'))
+            nav_buttons.extend([
+                InlineKeyboardButton("➕ Добавить шаблон", callback_data='add_template'),
+                InlineKeyboardButton("✏️ Редактировать шаблон", callback_data='edit_template'),
+                InlineKeyboardButton("🚪 Вернуться в меню", callback_data='cancel_template')
+            ])
+            keyboard.append(nav_buttons)
+            return InlineKeyboardMarkup(keyboard)
+
+        inline_reply_markup = get_page_keyboard('template', data, page, build_keyboard)
         text = f"📋 Шаблоны ответов (страница {page + 1}/{total_pages}):"
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
 
         if update.message:
             message = update.message.reply_text(
@@ -549,25 +971,19 @@ def display_template_page(update: Update, context: CallbackContext, data, page):
                 reply_markup=inline_reply_markup,
                 reply_to_message_id=None
             )
+            context.user_data['page_message_id'] = message.message_id
             # Планируем автоудаление списка через 4 часа
             context.job_queue.run_once(
                 lambda ctx: clear_chat(ctx, update.effective_chat.id, message.message_id, user_display),
                 14400,
                 context=None
             )
-            # Отправляем сообщение с главным меню
-            menu_message = update.message.reply_text("Выберите нужный пункт", reply_markup=MAIN_MENU)
-            # Планируем автоудаление сообщения "Выберите нужный пункт" через 4 часа
-            context.job_queue.run_once(
-                lambda ctx: clear_chat(ctx, update.effective_chat.id, menu_message.message_id, user_display),
-                14400,
-                context=None
-            )
         elif update.callback_query:
             update.callback_query.message.edit_text(
                 text,
                 reply_markup=inline_reply_markup
             )
+            context.user_data['page_message_id'] = update.callback_query.message.message_id
             # Планируем автоудаление отредактированного сообщения через 4 часа
             context.job_queue.run_once(
                 lambda ctx: clear_chat(ctx, update.effective_chat.id, update.callback_query.message.message_id, user_display),
@@ -575,13 +991,12 @@ def display_template_page(update: Update, context: CallbackContext, data, page):
                 context=None
             )
 
-        logger.info(f"Пользователь {user_display} просмотрел страницу шаблонов {page + 1}")
+        logger.debug("Пользователь %s просмотрел страницу шаблонов %s", user_display, page + 1)
         context.user_data['conversation_state'] = 'TEMPLATE_PAGE'
         context.user_data['conversation_active'] = False
         return ConversationHandler.END
 
     except Exception as e:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
         logger.error(f"Ошибка в display_template_page для пользователя {user_display}: {str(e)}", exc_info=True)
         if update.message:
             update.message.reply_text(
@@ -611,22 +1026,15 @@ def show_answer(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     try:
-        data_type, _, question_id = query.data.split('_')
-        question_id = int(question_id)
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        logger.info(f"Пользователь {user_display} запросил ответ для {data_type} ID {question_id}")
+        data_type = CALLBACK_DATA_TYPES[query.data[0]]
+        question_id = int(query.data[1:])
+        user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+        logger.debug("Пользователь %s запросил ответ для %s ID %s", user_display, data_type, question_id)
         # Запись действия с никнеймом
-        context.bot_data['user_actions'].append({
-            'user_id': update.effective_user.id,
-            'username': update.effective_user.username or f"ID {update.effective_user.id}",  # Сохраняем никнейм или ID
-            'action': 'show_answer',
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'details': f"Пользователь открыл пункт {data_type} ID {question_id}"
-        })
+        record_action(context, update.effective_user, 'show_answer', f"Пользователь открыл пункт {data_type} ID {question_id}")
         # Остальной код без изменений
         data = load_data(data_type)
-        key = 'questions' if data_type == 'guide' else 'templates'
-        item = next((q for q in data[key] if q["id"] == question_id), None)
+        item = get_id_index(data_type, data).get(question_id)
         if not item:
             logger.error(f"Пункт {data_type} с ID {question_id} не найден для пользователя {user_display}")
             query.message.reply_text(
@@ -639,6 +1047,8 @@ def show_answer(update: Update, context: CallbackContext):
         photo_ids = item.get('photos', []) or ([item['photo']] if item.get('photo') else [])
         doc_ids = item.get('documents', [])
         message_ids = []
+        # Кнопка удаления прикрепляется к последнему документу, если он есть,
+        # отдельное сообщение с кнопкой нужно только после альбома без документов
         if ENABLE_PHOTOS and photo_ids:
             valid_photo_ids = [pid for pid in photo_ids if isinstance(pid, str) and pid.strip()]
             if not valid_photo_ids:
@@ -647,41 +1057,38 @@ def show_answer(update: Update, context: CallbackContext):
                 message = query.message.reply_photo(
                     photo=valid_photo_ids[0],
                     caption=response,
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🗑 Удалить", callback_data='delete_answer')]])
+                    reply_markup=None if doc_ids else DELETE_ANSWER_MARKUP
                 )
                 message_ids.append(message.message_id)
             else:
                 media = [InputMediaPhoto(media=pid, caption=response if i == 0 else None) for i, pid in enumerate(valid_photo_ids)]
                 messages = query.message.reply_media_group(media=media)
                 message_ids.extend([msg.message_id for msg in messages])
-                delete_message = query.message.reply_text(
-                    "Нажмите, чтобы удалить ответ:",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🗑 Удалить", callback_data='delete_answer')]])
-                )
-                message_ids.append(delete_message.message_id)
+                if not doc_ids:
+                    delete_message = query.message.reply_text(
+                        "Нажмите, чтобы удалить ответ:",
+                        reply_markup=DELETE_ANSWER_MARKUP
+                    )
+                    message_ids.append(delete_message.message_id)
         if doc_ids:
+            last_doc_index = len(doc_ids) - 1
             for i, doc_id in enumerate(doc_ids):
                 message = query.message.reply_document(
                     document=doc_id,
                     caption=response if i == 0 and not photo_ids else None,
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🗑 Удалить", callback_data='delete_answer')]]) if i == 0 and not photo_ids else None
+                    reply_markup=DELETE_ANSWER_MARKUP if i == last_doc_index else None
                 )
                 message_ids.append(message.message_id)
-            if photo_ids and doc_ids:
-                delete_message = query.message.reply_text(
-                    "Нажмите, чтобы удалить ответ:",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🗑 Удалить", callback_data='delete_answer')]])
-                )
-                message_ids.append(delete_message.message_id)
         if not photo_ids and not doc_ids:
             message = query.message.reply_text(
                 response,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🗑 Удалить", callback_data='delete_answer')]])
+                reply_markup=DELETE_ANSWER_MARKUP
             )
             message_ids.append(message.message_id)
         context.user_data['answer_message_ids'] = message_ids
         context.user_data['current_question_id'] = question_id
-        logger.debug(f"Сохранены message_ids: {message_ids} для question_id: {question_id} для пользователя {user_display}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Сохранены message_ids: %s для question_id: %s для пользователя %s", message_ids, question_id, user_display)
         context.job_queue.run_once(
             schedule_message_deletion,
             1800,
@@ -702,9 +1109,17 @@ def handle_pagination(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     try:
-        data_type, _, page = query.data.split('_')
-        page = int(page)
-        data = context.user_data.get('data', load_data(data_type))
+        data_type = CALLBACK_DATA_TYPES[query.data[1]]
+        page = int(query.data[2:])
+        # Повторное нажатие (например, двойной клик) на уже открытую страницу этого же
+        # сообщения: клавиатура не меняется, а edit_text вернул бы "Message is not modified"
+        if (context.user_data.get('page_message_id') == query.message.message_id
+                and context.user_data.get('data_type') == data_type
+                and context.user_data.get('page') == page):
+            return ConversationHandler.END
+        data = context.user_data.get('data')
+        if data is None:
+            data = load_data(data_type)
         if data_type == 'guide':
             display_guide_page(update, context, data, page, data_type)
         else:
@@ -732,9 +1147,11 @@ def handle_template_action(update: Update, context: CallbackContext):
         elif action == 'edit_template':
             return edit_template(update, context)
         elif action == 'cancel_template':
-            context.user_data.clear()
-            context.user_data['conversation_state'] = 'CANCEL_TEMPLATE'
-            context.user_data['conversation_active'] = False
+            reset_user_data(
+                context.user_data,
+                conversation_state='CANCEL_TEMPLATE',
+                conversation_active=False
+            )
             query.message.reply_text("🚪 Вернулись в главное меню.", reply_markup=MAIN_MENU)
             return ConversationHandler.END
         return ConversationHandler.END
@@ -746,33 +1163,39 @@ def handle_template_action(update: Update, context: CallbackContext):
         )
         return ConversationHandler.END
 
+# Текстовые сообщения вне диалогов: кнопка меню -> её обработчик, остальное -> поиск.
+# «Добавить»/«Редактировать» обычно перехватывают точки входа ConversationHandler'ов
+def route_text_message(update: Update, context: CallbackContext):
+    handler = MENU_HANDLERS.get(update.message.text, perform_search)
+    return handler(update, context)
+
 # Поиск по ключевым словам
 @restrict_access
 def perform_search(update: Update, context: CallbackContext):
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     if context.user_data.get('conversation_active', False):
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        logger.info(f"Пользователь {user_display} находится в активном диалоге ({context.user_data.get('conversation_state')}), пропускаем perform_search")
+        logger.info("Пользователь %s находится в активном диалоге (%s), пропускаем perform_search", user_display, context.user_data.get('conversation_state'))
         return
     try:
-        logger.info(f"Пользователь {update.effective_user.id} вошел в perform_search с текстом: '{update.message.text}'")
+        logger.info("Пользователь %s вошел в perform_search с текстом: '%s'", update.effective_user.id, update.message.text)
         if not update.message or not update.message.text:
-            logger.error(f"Пользователь {update.effective_user.id} отправил пустое или неверное сообщение для поиска")
+            logger.error("Пользователь %s отправил пустое или неверное сообщение для поиска", update.effective_user.id)
             update.message.reply_text(
                 "❌ Пожалуйста, введите ключевое слово для поиска!",
                 reply_markup=MAIN_MENU
             )
             return
         keyword = update.message.text.lower().strip()
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        logger.info(f"Пользователь {user_display} выполнил поиск по ключевому слову '{keyword}'")
+        # Запросы короче MIN_SEARCH_LENGTH не ищем: такой "ключ" совпадает почти со всем
+        if len(keyword) < MIN_SEARCH_LENGTH:
+            update.message.reply_text(
+                f"🔍 Введите не менее {MIN_SEARCH_LENGTH} символов для поиска.",
+                reply_markup=MAIN_MENU
+            )
+            return
+        logger.info("Пользователь %s выполнил поиск по ключевому слову '%s'", user_display, keyword)
         # Запись действия с никнеймом
-        context.bot_data['user_actions'].append({
-            'user_id': update.effective_user.id,
-            'username': update.effective_user.username or f"ID {update.effective_user.id}",
-            'action': 'perform_search',
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'details': f"Пользователь выполнил поиск по ключевому слову '{keyword}'"
-        })
+        record_action(context, update.effective_user, 'perform_search', f"Пользователь выполнил поиск по ключевому слову '{keyword}'")
         # Остальной код без изменений
         guide = load_guide()
         if not isinstance(guide, dict) or "questions" not in guide or not isinstance(guide["questions"], list):
@@ -782,23 +1205,14 @@ def perform_search(update: Update, context: CallbackContext):
                 reply_markup=MAIN_MENU
             )
             return
-        morph = pymorphy3.MorphAnalyzer()
-        keyword_normalized = morph.parse(keyword)[0].normal_form
-        logger.debug(f"Нормализованное ключевое слово: '{keyword_normalized}'")
+        keyword_words = frozenset(normalize_words(keyword)) if guide["questions"] else frozenset()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Нормализованные ключевые слова: %s", keyword_words)
         results = []
-        for q in guide["questions"]:
-            if not (isinstance(q, dict) and "question" in q and isinstance(q["question"], str)):
-                continue
-            question_words = [morph.parse(word)[0].normal_form for word in q["question"].lower().split()]
-            answer_words = (
-                [morph.parse(word)[0].normal_form for word in q["answer"].lower().split()]
-                if q.get("answer") and isinstance(q["answer"], str)
-                else []
-            )
-            if keyword_normalized in question_words or keyword_normalized in answer_words:
-                results.append(q)
+        if keyword_words:
+            results = list(get_guide_search(guide)(keyword_words))
         if not results:
-            logger.info(f"Результаты для ключевого слова '{keyword}' не найдены")
+            logger.info("Результаты для ключевого слова '%s' не найдены", keyword)
             update.message.reply_text(
                 "🔍 Ничего не найдено. Попробуйте другое ключевое слово!",
                 reply_markup=MAIN_MENU
@@ -810,140 +1224,93 @@ def perform_search(update: Update, context: CallbackContext):
         context.user_data['conversation_state'] = 'SEARCH'
         context.user_data['conversation_active'] = False
         context.user_data['search_query'] = keyword
-        logger.debug(f"Найдено {len(results)} пунктов для запроса '{keyword}': {[item['id'] for item in results]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Найдено %s пунктов для запроса '%s': %s", len(results), keyword, [item['id'] for item in results])
         display_guide_page(update, context, {"questions": results}, 0, 'guide')
         return
     except Exception as e:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        logger.error(f"Ошибка в perform_search для пользователя {user_display}: {str(e)}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
-        update.message.reply_text(
-            "❌ Произошла ошибка при поиске. Попробуйте снова или свяжитесь с администратором.",
-            reply_markup=MAIN_MENU
-        )
+        logger.error("Ошибка в perform_search для пользователя %s: %s", user_display, e, exc_info=True)
+        end_with_error(update, context, 'ERROR', "❌ Произошла ошибка при поиске. Попробуйте снова или свяжитесь с администратором.")
         return
 
 # Добавление пункта в справочник
 @restrict_access
+@log_action('add_point', 'Пользователь начал добавление пункта в справочник')
 def add_point(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-    logger.info(f"Пользователь {user_display} начал добавление нового пункта справочника")
-    # Запись действия с никнеймом
-    if 'user_actions' not in context.bot_data:
-        context.bot_data['user_actions'] = []
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",
-        'action': 'add_point',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь начал добавление пункта в справочник'
-    })
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+    logger.info("Пользователь %s начал добавление нового пункта справочника", user_display)
     # Остальной код без изменений
-    context.user_data.clear()
-    context.user_data['photos'] = []
-    context.user_data['media_group_id'] = None
-    context.user_data['last_photo_time'] = None
-    context.user_data['point_saved'] = False
-    context.user_data['loading_message_id'] = None
-    context.user_data['timeout_task'] = None
-    context.user_data['conversation_state'] = 'ADD_GUIDE'
-    context.user_data['conversation_active'] = True
-    context.user_data['data_type'] = 'guide'
+    reset_user_data(
+        context.user_data,
+        photos=[],
+        media_group_id=None,
+        last_photo_time=None,
+        point_saved=False,
+        loading_message_id=None,
+        timeout_task=None,
+        conversation_state='ADD_GUIDE',
+        conversation_active=True,
+        data_type='guide'
+    )
     try:
         message = update.message.reply_text(
             "➕ Введите вопрос (например, 'Ошибка входа в систему'):\n(Напишите /cancel для отмены)",
-            reply_markup=ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True),
+            reply_markup=CANCEL_MENU,
             quote=False
         )
-        logger.info(f"Пользователь {user_display} успешно запустил add_point")
+        logger.info("Пользователь %s успешно запустил add_point", user_display)
         return GUIDE_QUESTION
     except Exception as e:
-        logger.error(f"Ошибка в add_point для пользователя {user_display}: {e}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
-        update.message.reply_text(
-            "❌ Ошибка при добавлении пункта. Попробуйте снова.",
-            reply_markup=MAIN_MENU
-        )
-        return ConversationHandler.END
+        logger.error("Ошибка в add_point для пользователя %s: %s", user_display, e, exc_info=True)
+        return end_with_error(update, context, 'ERROR', "❌ Ошибка при добавлении пункта. Попробуйте снова.")
 
 # Добавление шаблона
 @restrict_access
 def add_template(update: Update, context: CallbackContext):
-    logger.info(f"Пользователь {update.effective_user.id} начал добавление нового шаблона")
-    context.user_data.clear()
-    context.user_data['photos'] = []
-    context.user_data['media_group_id'] = None
-    context.user_data['last_photo_time'] = None
-    context.user_data['point_saved'] = False
-    context.user_data['loading_message_id'] = None
-    context.user_data['timeout_task'] = None
-    context.user_data['conversation_state'] = 'ADD_TEMPLATE'
-    context.user_data['conversation_active'] = True
-    context.user_data['data_type'] = 'template'
+    logger.info("Пользователь %s начал добавление нового шаблона", update.effective_user.id)
+    reset_user_data(
+        context.user_data,
+        photos=[],
+        media_group_id=None,
+        last_photo_time=None,
+        point_saved=False,
+        loading_message_id=None,
+        timeout_task=None,
+        conversation_state='ADD_TEMPLATE',
+        conversation_active=True,
+        data_type='template'
+    )
     try:
         if update.message:
             update.message.reply_text(
                 "➕ Введите вопрос для шаблона (например, 'Шаблон ответа на запрос'):\n(Напишите /cancel для отмены)",
-                reply_markup=ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True),
+                reply_markup=CANCEL_MENU,
                 quote=False
             )
         elif update.callback_query:
             update.callback_query.message.reply_text(
                 "➕ Введите вопрос для шаблона (например, 'Шаблон ответа на запрос'):\n(Напишите /cancel для отмены)",
-                reply_markup=ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True),
+                reply_markup=CANCEL_MENU,
                 quote=False
             )
-        logger.info(f"Пользователь {update.effective_user.id} успешно запустил add_template")
+        logger.info("Пользователь %s успешно запустил add_template", update.effective_user.id)
         return TEMPLATE_QUESTION
     except Exception as e:
-        logger.error(f"Ошибка в add_template для пользователя {update.effective_user.id}: {e}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
-        if update.message:
-            update.message.reply_text(
-                "❌ Ошибка при добавлении шаблона. Попробуйте снова.",
-                reply_markup=MAIN_MENU
-            )
-        elif update.callback_query:
-            update.callback_query.message.reply_text(
-                "❌ Ошибка при добавлении шаблона. Попробуйте снова.",
-                reply_markup=MAIN_MENU
-            )
-        return ConversationHandler.END
+        logger.error("Ошибка в add_template для пользователя %s: %s", update.effective_user.id, e, exc_info=True)
+        return end_with_error(update, context, 'ERROR', "❌ Ошибка при добавлении шаблона. Попробуйте снова.")
 
 # Обработка вопроса
 @restrict_access
 def receive_question(update: Update, context: CallbackContext):
-    logger.info(f"Пользователь {update.effective_user.id} вошел в receive_question, состояние: {context.user_data.get('conversation_state')}, текст: '{update.message.text}'")
+    logger.info("Пользователь %s вошел в receive_question, состояние: %s, текст: '%s'", update.effective_user.id, context.user_data.get('conversation_state'), update.message.text)
     if not context.user_data.get('conversation_active', False):
-        logger.warning(f"Пользователь {update.effective_user.id} попытался отправить вопрос в неактивном диалоге")
-        update.message.reply_text(
-            f"❌ Пожалуйста, начните добавление {'пункта' if context.user_data.get('data_type') == 'guide' else 'шаблона'} заново.",
-            reply_markup=MAIN_MENU,
-            quote=False
-        )
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'INVALID_QUESTION'
-        context.user_data['conversation_active'] = False
-        return ConversationHandler.END
+        logger.warning("Пользователь %s попытался отправить вопрос в неактивном диалоге", update.effective_user.id)
+        return end_with_error(update, context, 'INVALID_QUESTION', f"❌ Пожалуйста, начните добавление {'пункта' if context.user_data.get('data_type') == 'guide' else 'шаблона'} заново.")
     data_type = context.user_data.get('data_type', 'guide')
     if data_type not in ['guide', 'template']:
-        logger.error(f"Недопустимый data_type: {data_type}")
-        update.message.reply_text(
-            "❌ Ошибка: Неверный тип данных. Начните заново.",
-            reply_markup=MAIN_MENU,
-            quote=False
-        )
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'INVALID_DATA_TYPE'
-        context.user_data['conversation_active'] = False
-        return ConversationHandler.END
-    logger.info(f"Пользователь {update.effective_user.id} ввел вопрос для {data_type}: {update.message.text}")
+        logger.error("Недопустимый data_type: %s", data_type)
+        return end_with_error(update, context, 'INVALID_DATA_TYPE', "❌ Ошибка: Неверный тип данных. Начните заново.")
+    logger.info("Пользователь %s ввел вопрос для %s: %s", update.effective_user.id, data_type, update.message.text)
     context.user_data['new_question'] = update.message.text
     context.user_data['conversation_state'] = f'RECEIVE_{data_type.upper()}_QUESTION'
     prompt = "Введите ответ"
@@ -952,74 +1319,47 @@ def receive_question(update: Update, context: CallbackContext):
     prompt += ":\n(Напишите /cancel для отмены)"
     update.message.reply_text(
         prompt,
-        reply_markup=ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True),
+        reply_markup=CANCEL_MENU,
         quote=False
     )
-    logger.info(f"Переход в состояние {'GUIDE_ANSWER' if data_type == 'guide' else 'TEMPLATE_ANSWER'} для пользователя {update.effective_user.id}")
+    logger.info("Переход в состояние %s для пользователя %s", 'GUIDE_ANSWER' if data_type == 'guide' else 'TEMPLATE_ANSWER', update.effective_user.id)
     return GUIDE_ANSWER if data_type == 'guide' else TEMPLATE_ANSWER
 
 # Обработка ответа
 @restrict_access
 def receive_answer(update: Update, context: CallbackContext):
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     if not context.user_data.get('conversation_active', False) or 'new_question' not in context.user_data:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        logger.warning(f"Пользователь {user_display} попытался отправить ответ без активного диалога или вопроса")
-        update.message.reply_text(
-            f"❌ Пожалуйста, начните добавление {'пункта' if context.user_data.get('data_type') == 'guide' else 'шаблона'} заново.",
-            reply_markup=MAIN_MENU,
-            quote=False
-        )
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'INVALID_ANSWER'
-        context.user_data['conversation_active'] = False
-        return ConversationHandler.END
+        logger.warning("Пользователь %s попытался отправить ответ без активного диалога или вопроса", user_display)
+        return end_with_error(update, context, 'INVALID_ANSWER', f"❌ Пожалуйста, начните добавление {'пункта' if context.user_data.get('data_type') == 'guide' else 'шаблона'} заново.")
     data_type = context.user_data.get('data_type', 'guide')
     if data_type not in ['guide', 'template']:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        logger.error(f"Недопустимый data_type: {data_type}")
-        update.message.reply_text(
-            "❌ Ошибка: Неверный тип данных. Начните заново.",
-            reply_markup=MAIN_MENU,
-            quote=False
-        )
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'INVALID_DATA_TYPE'
-        context.user_data['conversation_active'] = False
-        return ConversationHandler.END
-    if 'photos' not in context.user_data:
-        context.user_data['photos'] = []
-    if 'documents' not in context.user_data:
-        context.user_data['documents'] = []
-    if 'pending_photos' not in context.user_data:
-        context.user_data['pending_photos'] = []
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
+        logger.error("Недопустимый data_type: %s", data_type)
+        return end_with_error(update, context, 'INVALID_DATA_TYPE', "❌ Ошибка: Неверный тип данных. Начните заново.")
+    context.user_data.setdefault('photos', [])
+    context.user_data.setdefault('documents', [])
+    context.user_data.setdefault('pending_photos', [])
 
     if update.message.text == "Готово":
         if context.user_data.get('pending_photos'):
-            unique_photos = list(dict.fromkeys(context.user_data['pending_photos']))
-            context.user_data['photos'].extend([pid for pid in unique_photos if pid not in context.user_data['photos']])
-            logger.info(f"Пользователь {user_display} добавил {len(unique_photos)} новых фото из pending_photos в {data_type}: {unique_photos}")
-            context.user_data['pending_photos'] = []
+            unique_photos = merge_pending_photos(context.user_data)
+            logger.info("Пользователь %s добавил %s новых фото из pending_photos в %s: %s", user_display, len(unique_photos), data_type, unique_photos)
         save_new_point(update, context, send_message=True)
         # Запись действия с никнеймом
-        context.bot_data['user_actions'].append({
-            'user_id': update.effective_user.id,
-            'username': update.effective_user.username or f"ID {update.effective_user.id}",
-            'action': 'save_point',
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'details': f"Пользователь сохранил пункт в {data_type}: {context.user_data.get('new_question', 'Без вопроса')}"
-        })
-        context.user_data.clear()
-        context.user_data['conversation_state'] = f'{data_type.upper()}_FILES_SAVED'
-        context.user_data['conversation_active'] = False
+        record_action(context, update.effective_user, 'save_point', f"Пользователь сохранил пункт в {data_type}: {context.user_data.get('new_question', 'Без вопроса')}")
+        reset_user_data(
+            context.user_data,
+            conversation_state=f'{data_type.upper()}_FILES_SAVED',
+            conversation_active=False
+        )
         return ConversationHandler.END
     # Остальной код без изменений
     elif update.message.photo:
         if update.message.media_group_id:
             context.user_data['media_group_id'] = update.message.media_group_id
-            context.user_data['pending_photos'].append(update.message.photo[-1].file_id)
+            add_pending_photo(context.user_data, update.message.photo[-1].file_id)
             context.user_data['last_photo_time'] = update.message.date
-            logger.info(f"Пользователь {user_display} добавил фото в альбом {data_type} media group {update.message.media_group_id}: {update.message.photo[-1].file_id}")
+            logger.info("Пользователь %s добавил фото в альбом %s media group %s: %s", user_display, data_type, update.message.media_group_id, update.message.photo[-1].file_id)
             if len(context.user_data['pending_photos']) == 1:
                 loading_message = update.message.reply_text("⏳ Загрузка...", quote=False)
                 context.user_data['loading_message_id'] = loading_message.message_id
@@ -1030,10 +1370,11 @@ def receive_answer(update: Update, context: CallbackContext):
             return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
         else:
             context.user_data['photos'] = [update.message.photo[-1].file_id]
-            logger.info(f"Пользователь {user_display} добавил одно фото в {data_type}: {context.user_data['photos']}")
+            context.user_data.pop('_photos_set', None)
+            logger.info("Пользователь %s добавил одно фото в %s: %s", user_display, data_type, context.user_data['photos'])
             update.message.reply_text(
                 f"✅ Фото добавлено ({len(context.user_data['photos'])}). Отправьте ещё файлы, текст или нажмите 'Готово':",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                reply_markup=DONE_CANCEL_MENU,
                 quote=False
             )
         if update.message.caption and not context.user_data.get('answer'):
@@ -1041,83 +1382,144 @@ def receive_answer(update: Update, context: CallbackContext):
         return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
     elif update.message.document:
         doc = update.message.document
-        if doc.mime_type not in [
-            'application/msword',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'application/pdf',
-            'application/vnd.ms-excel',
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        ]:
+        if doc.mime_type not in ALLOWED_DOC_MIMES:
             update.message.reply_text(
                 "❌ Поддерживаются только файлы .doc, .docx, .pdf, .xls, .xlsx!",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                reply_markup=DONE_CANCEL_MENU,
                 quote=False
             )
             return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
-        if doc.file_size > 20 * 1024 * 1024:
+        if doc.file_size > MAX_DOC_BYTES:
             update.message.reply_text(
                 "❌ Файл слишком большой! Максимальный размер — 20 МБ.",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                reply_markup=DONE_CANCEL_MENU,
+                quote=False
+            )
+            return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
+        if not document_content_ok(context.bot, doc):
+            update.message.reply_text(
+                "❌ Содержимое файла не похоже на .doc, .docx, .pdf, .xls или .xlsx!",
+                reply_markup=DONE_CANCEL_MENU,
                 quote=False
             )
             return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
         if doc.file_id not in context.user_data['documents']:
             context.user_data['documents'].append(doc.file_id)
-            logger.info(f"Пользователь {user_display} добавил документ в {data_type}: {doc.file_id}")
+            logger.info("Пользователь %s добавил документ в %s: %s", user_display, data_type, doc.file_id)
             if update.message.caption and not context.user_data.get('answer'):
                 context.user_data['answer'] = update.message.caption
             update.message.reply_text(
                 f"✅ Документ добавлен ({len(context.user_data['documents'])}). Отправьте ещё файлы, текст или нажмите 'Готово':",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                reply_markup=DONE_CANCEL_MENU,
                 quote=False
             )
     else:
         context.user_data['answer'] = update.message.text
         update.message.reply_text(
             f"✅ Ответ сохранён. Отправьте ещё файлы или нажмите 'Готово':",
-            reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+            reply_markup=DONE_CANCEL_MENU,
             quote=False
         )
     return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
 
+# Завершение диалога с ошибкой: сброс состояния пользователя и сообщение с главным меню
+def end_with_error(update: Update, context: CallbackContext, state: str, text: str):
+    reset_user_data(context.user_data, conversation_state=state, conversation_active=False)
+    message = update.message or update.callback_query.message
+    message.reply_text(text, reply_markup=MAIN_MENU, quote=False)
+    return ConversationHandler.END
+
+# Ставит фото альбома в pending_photos, если его ещё нет ни там, ни в photos.
+# '_photos_set' — множество-зеркало photos + pending_photos для проверки за O(1)
+def add_pending_photo(user_data, file_id: str) -> bool:
+    seen = user_data.get('_photos_set')
+    if seen is None:
+        seen = user_data['_photos_set'] = set(user_data['photos']).union(user_data['pending_photos'])
+    if file_id in seen:
+        return False
+    seen.add(file_id)
+    user_data['pending_photos'].append(file_id)
+    return True
+
+# Переносит фото альбома из pending_photos в photos и очищает pending_photos;
+# повторы отсеяны ещё в add_pending_photo. Возвращает добавленные фото
+def merge_pending_photos(user_data) -> list:
+    added = list(user_data['pending_photos'])
+    user_data['photos'].extend(added)
+    user_data['pending_photos'].clear()
+    return added
+
+# Определение типа документа по содержимому: скачиваются только первые SNIFF_BYTES байт.
+# Возвращает None, если проверка недоступна или не удалась
+def sniff_mime(bot, file_id: str):
+    global MAGIC
+    if magic is None:
+        return None
+    # В PTB 13 file_path — полный URL с токеном бота, а исключения requests включают URL
+    # в текст, поэтому в журнал пишется только тип ошибки или код ответа
+    try:
+        file_url = bot.get_file(file_id).file_path
+        with requests.get(file_url, headers={'Range': f'bytes=0-{SNIFF_BYTES - 1}'}, stream=True, timeout=SNIFF_TIMEOUT) as response:
+            response.raise_for_status()
+            head = response.raw.read(SNIFF_BYTES)
+        with MAGIC_LOCK:
+            if MAGIC is None:
+                MAGIC = magic.Magic(mime=True)
+            return MAGIC.from_buffer(head)
+    except requests.Timeout:
+        logger.info("Тип файла %s не проверен: превышено время ожидания", file_id)
+    except requests.HTTPError as e:
+        logger.warning("Не удалось определить тип файла %s: HTTP %s", file_id, e.response.status_code)
+    except Exception as e:
+        logger.warning("Не удалось определить тип файла %s: %s", file_id, type(e).__name__)
+    return None
+
+# Содержимое документа соответствует допустимым форматам (или проверить его нельзя)
+def document_content_ok(bot, doc) -> bool:
+    sniffed = sniff_mime(bot, doc.file_id)
+    if sniffed is None or sniffed in SNIFFED_DOC_MIMES:
+        return True
+    logger.info("Отклонён файл %s: заявлен %s, по содержимому %s", doc.file_name, doc.mime_type, sniffed)
+    return False
+
 # Проверка таймаута альбома
 def check_album_timeout(context: CallbackContext):
     update, context = context.job.context
     data_type = context.user_data.get('data_type', 'guide')
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-    logger.info(f"Пользователь {user_display} завершил альбом для {data_type} media group {context.user_data.get('media_group_id')}")
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+    logger.info("Пользователь %s завершил альбом для %s media group %s", user_display, data_type, context.user_data.get('media_group_id'))
     if context.user_data.get('loading_message_id'):
         try:
             context.bot.delete_message(
                 chat_id=update.effective_chat.id,
                 message_id=context.user_data['loading_message_id']
             )
-            logger.info(f"Пользователь {user_display} удалил сообщение о загрузке")
+            logger.info("Пользователь %s удалил сообщение о загрузке", user_display)
         except Exception as e:
-            logger.error(f"Не удалось удалить сообщение о загрузке: {e}")
+            logger.error("Не удалось удалить сообщение о загрузке: %s", e)
     if context.user_data.get('pending_photos'):
-        unique_photos = list(dict.fromkeys(context.user_data['pending_photos']))
-        context.user_data['photos'].extend([pid for pid in unique_photos if pid not in context.user_data['photos']])
-        logger.info(f"Пользователь {user_display} добавил {len(unique_photos)} новых фото из pending_photos в {data_type}: {unique_photos}")
-        context.user_data['pending_photos'] = []
+        unique_photos = merge_pending_photos(context.user_data)
+        logger.info("Пользователь %s добавил %s новых фото из pending_photos в %s: %s", user_display, len(unique_photos), data_type, unique_photos)
         update.message.reply_text(
             f"✅ Фото добавлены ({len(context.user_data['photos'])}). Отправьте ещё файлы, текст или нажмите 'Готово':",
-            reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+            reply_markup=DONE_CANCEL_MENU,
             quote=False
         )
     context.user_data['media_group_id'] = None
     context.user_data['last_photo_time'] = None
     context.user_data['timeout_task'] = None
-    logger.info(f"Пользователь {user_display} завершил обработку альбома в check_album_timeout")
+    logger.info("Пользователь %s завершил обработку альбома в check_album_timeout", user_display)
     return None
 
 # Сохранение нового пункта
 def save_new_point(update: Update, context: CallbackContext, send_message: bool = False):
     data_type = context.user_data.get('data_type', 'guide')
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     data = load_data(data_type)
     key = 'questions' if data_type == 'guide' else 'templates'
-    new_id = max([q["id"] for q in data[key]], default=0) + 1
+    # Счётчик ID хранится в самом файле; перебор пунктов нужен только для файлов без него
+    new_id = data.get('_next_id') or max((q["id"] for q in data[key]), default=0) + 1
+    data['_next_id'] = new_id + 1
     new_point = {
         "id": new_id,
         "question": context.user_data['new_question'],
@@ -1125,13 +1527,13 @@ def save_new_point(update: Update, context: CallbackContext, send_message: bool
     }
     if context.user_data.get('photos'):
         new_point['photos'] = context.user_data['photos']
-        logger.info(f"Пользователь {user_display} добавил фото в {data_type}: {new_point['photos']}")
+        logger.info("Пользователь %s добавил фото в %s: %s", user_display, data_type, new_point['photos'])
     if context.user_data.get('documents'):
         new_point['documents'] = context.user_data['documents']
-        logger.info(f"Пользователь {user_display} добавил документы в {data_type}: {new_point['documents']}")
+        logger.info("Пользователь %s добавил документы в %s: %s", user_display, data_type, new_point['documents'])
     data[key].append(new_point)
     save_data(data_type, data)
-    logger.info(f"Пользователь {user_display} сохранил новый пункт в {data_type} с ID {new_id}: {new_point['question']}")
+    logger.info("Пользователь %s сохранил новый пункт в %s с ID %s: %s", user_display, data_type, new_id, new_point['question'])
     if send_message:
         update.message.reply_text(
             f"➕ {'Пункт' if data_type == 'guide' else 'Шаблон'} добавлен!\nВопрос: {new_point['question']}",
@@ -1143,14 +1545,11 @@ def save_new_point(update: Update, context: CallbackContext, send_message: bool
 @restrict_access
 def receive_answer_files(update: Update, context: CallbackContext):
     data_type = context.user_data.get('data_type', 'guide')
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     try:
-        if 'photos' not in context.user_data:
-            context.user_data['photos'] = []
-        if 'documents' not in context.user_data:
-            context.user_data['documents'] = []
-        if 'pending_photos' not in context.user_data:
-            context.user_data['pending_photos'] = []
+        context.user_data.setdefault('photos', [])
+        context.user_data.setdefault('documents', [])
+        context.user_data.setdefault('pending_photos', [])
         if 'last_photo_time' not in context.user_data:
             context.user_data['last_photo_time'] = None
 
@@ -1160,124 +1559,138 @@ def receive_answer_files(update: Update, context: CallbackContext):
         if total_files >= MAX_MEDIA_PER_ALBUM:
             update.message.reply_text(
                 f"❌ Максимум {MAX_MEDIA_PER_ALBUM} файлов (фото или документы) на пункт! Отправьте ещё файлы, текст или нажмите 'Готово':",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                reply_markup=DONE_CANCEL_MENU,
                 quote=False
             )
             if context.user_data.get('pending_photos'):
-                unique_photos = list(dict.fromkeys(context.user_data['pending_photos']))
-                context.user_data['photos'].extend([pid for pid in unique_photos if pid not in context.user_data['photos']])
-                logger.info(f"Пользователь {user_display} добавил {len(unique_photos)} новых фото из pending_photos в {data_type}: {unique_photos}")
-                context.user_data['pending_photos'] = []
+                unique_photos = merge_pending_photos(context.user_data)
+                logger.info("Пользователь %s добавил %s новых фото из pending_photos в %s: %s", user_display, len(unique_photos), data_type, unique_photos)
             return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
 
         if update.message.photo:
             new_photo = update.message.photo[-1].file_id
-            if new_photo not in context.user_data['pending_photos']:
-                context.user_data['pending_photos'].append(new_photo)
-            logger.debug(f"Пользователь {user_display} добавил в pending_photos: {new_photo}, media_group_id: {media_group_id}")
+            add_pending_photo(context.user_data, new_photo)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Пользователь %s добавил в pending_photos: %s, media_group_id: %s", user_display, new_photo, media_group_id)
             if update.message.caption and not context.user_data.get('answer'):
                 context.user_data['answer'] = update.message.caption
             if media_group_id:
                 if context.user_data.get('timeout_task'):
                     context.user_data['timeout_task'].remove()
-                    logger.debug(f"Удалена предыдущая задача таймаута для пользователя {user_display}")
+                    logger.debug("Удалена предыдущая задача таймаута для пользователя %s", user_display)
                 context.user_data['last_photo_time'] = update.message.date
                 context.user_data['timeout_task'] = context.job_queue.run_once(
                     check_album_timeout,
                     5,
                     context=(update, context)
                 )
-                logger.debug(f"Запланирован тайм-аут для альбома {media_group_id} для пользователя {user_display}")
+                logger.debug("Запланирован тайм-аут для альбома %s для пользователя %s", media_group_id, user_display)
             else:
-                unique_photos = list(dict.fromkeys(context.user_data['pending_photos']))
-                context.user_data['photos'].extend([pid for pid in unique_photos if pid not in context.user_data['photos']])
-                logger.info(f"Пользователь {user_display} добавил {len(unique_photos)} новых фото в {data_type}: {unique_photos}")
-                context.user_data['pending_photos'] = []
+                unique_photos = merge_pending_photos(context.user_data)
+                logger.info("Пользователь %s добавил %s новых фото в %s: %s", user_display, len(unique_photos), data_type, unique_photos)
                 update.message.reply_text(
                     f"✅ Фото добавлены ({len(context.user_data['photos'])}). Отправьте ещё файлы, текст или нажмите 'Готово':",
-                    reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                    reply_markup=DONE_CANCEL_MENU,
                     quote=False
                 )
             return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
         elif update.message.document:
             doc = update.message.document
-            if doc.mime_type not in [
-                'application/msword',
-                'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                'application/pdf',
-                'application/vnd.ms-excel',
-                'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            ]:
+            if doc.mime_type not in ALLOWED_DOC_MIMES:
                 update.message.reply_text(
                     "❌ Поддерживаются только файлы .doc, .docx, .pdf, .xls, .xlsx!",
-                    reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                    reply_markup=DONE_CANCEL_MENU,
                     quote=False
                 )
                 return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
-            if doc.file_size > 20 * 1024 * 1024:
+            if doc.file_size > MAX_DOC_BYTES:
                 update.message.reply_text(
                     "❌ Файл слишком большой! Максимальный размер — 20 МБ.",
-                    reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                    reply_markup=DONE_CANCEL_MENU,
+                    quote=False
+                )
+                return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
+            if not document_content_ok(context.bot, doc):
+                update.message.reply_text(
+                    "❌ Содержимое файла не похоже на .doc, .docx, .pdf, .xls или .xlsx!",
+                    reply_markup=DONE_CANCEL_MENU,
                     quote=False
                 )
                 return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
             if doc.file_id not in context.user_data['documents']:
                 context.user_data['documents'].append(doc.file_id)
-                logger.info(f"Пользователь {user_display} добавил документ в {data_type}: {doc.file_id}")
+                logger.info("Пользователь %s добавил документ в %s: %s", user_display, data_type, doc.file_id)
                 if update.message.caption and not context.user_data.get('answer'):
                     context.user_data['answer'] = update.message.caption
                 update.message.reply_text(
                     f"✅ Документ добавлен ({len(context.user_data['documents'])}). Отправьте ещё файлы, текст или нажмите 'Готово':",
-                    reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                    reply_markup=DONE_CANCEL_MENU,
                     quote=False
                 )
         elif update.message.text == "Готово":
             if not context.user_data.get('new_question'):
-                update.message.reply_text(
-                    "❌ Вопрос не задан! Начните добавление заново.",
-                    reply_markup=MAIN_MENU,
-                    quote=False
-                )
-                context.user_data.clear()
-                context.user_data['conversation_state'] = 'NO_QUESTION'
-                context.user_data['conversation_active'] = False
-                return ConversationHandler.END
+                return end_with_error(update, context, 'NO_QUESTION', "❌ Вопрос не задан! Начните добавление заново.")
             if context.user_data.get('pending_photos'):
-                unique_photos = list(dict.fromkeys(context.user_data['pending_photos']))
-                context.user_data['photos'].extend([pid for pid in unique_photos if pid not in context.user_data['photos']])
-                logger.info(f"Пользователь {user_display} добавил {len(unique_photos)} новых фото из pending_photos в {data_type}: {unique_photos}")
-                context.user_data['pending_photos'] = []
+                unique_photos = merge_pending_photos(context.user_data)
+                logger.info("Пользователь %s добавил %s новых фото из pending_photos в %s: %s", user_display, len(unique_photos), data_type, unique_photos)
             save_new_point(update, context, send_message=True)
             # Запись действия с никнеймом
-            context.bot_data['user_actions'].append({
-                'user_id': update.effective_user.id,
-                'username': update.effective_user.username or f"ID {update.effective_user.id}",
-                'action': 'save_point',
-                'timestamp': datetime.now(timezone.utc).isoformat(),
-                'details': f"Пользователь сохранил пункт в {data_type}: {context.user_data.get('new_question', 'Без вопроса')}"
-            })
-            context.user_data.clear()
-            context.user_data['conversation_state'] = f'{data_type.upper()}_FILES_SAVED'
-            context.user_data['conversation_active'] = False
+            record_action(context, update.effective_user, 'save_point', f"Пользователь сохранил пункт в {data_type}: {context.user_data.get('new_question', 'Без вопроса')}")
+            reset_user_data(
+                context.user_data,
+                conversation_state=f'{data_type.upper()}_FILES_SAVED',
+                conversation_active=False
+            )
             return ConversationHandler.END
         else:
             update.message.reply_text(
                 "❌ Пожалуйста, отправьте фото или документ (.doc, .docx, .pdf, .xls, .xlsx)!",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
+                reply_markup=DONE_CANCEL_MENU,
                 quote=False
             )
         return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
     except Exception as e:
-        logger.error(f"Ошибка в receive_answer_files для пользователя {user_display}: {str(e)}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
-        update.message.reply_text(
-            "❌ Произошла ошибка при загрузке файла. Попробуйте снова.",
-            reply_markup=MAIN_MENU,
-            quote=False
-        )
-        return ConversationHandler.END
+        logger.error("Ошибка в receive_answer_files для пользователя %s: %s", user_display, e, exc_info=True)
+        return end_with_error(update, context, 'ERROR', "❌ Произошла ошибка при загрузке файла. Попробуйте снова.")
+
+# Пул для удаления сообщений: запросы к API идут параллельно, а не по одному
+DELETE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='delete')
+BULK_DELETE_LIMIT = 100  # максимум message_ids в одном вызове deleteMessages
+BULK_DELETE_SUPPORTED = True
+
+# Удаление пачками через метод Bot API deleteMessages (в PTB 13 обёртки нет, вызываем напрямую).
+# Сообщения, которые удалить нельзя, Telegram молча пропускает. Возвращает False, если
+# пачку удалить не удалось — тогда вызывающий удаляет сообщения по одному
+def bulk_delete_messages(bot, chat_id: int, message_ids) -> bool:
+    global BULK_DELETE_SUPPORTED
+    if not BULK_DELETE_SUPPORTED:
+        return False
+    message_ids = list(message_ids)
+    try:
+        for start in range(0, len(message_ids), BULK_DELETE_LIMIT):
+            bot._post('deleteMessages', {'chat_id': chat_id, 'message_ids': message_ids[start:start + BULK_DELETE_LIMIT]})
+        return True
+    except InvalidToken:
+        # Bot API отвечает 404 на неизвестный метод (старый локальный сервер Bot API)
+        BULK_DELETE_SUPPORTED = False
+        logger.warning("Метод deleteMessages не поддерживается, сообщения удаляются по одному")
+    except Exception as e:
+        logger.debug(f"Не удалось удалить пачку сообщений в чате {chat_id}: {e}")
+    return False
+
+def delete_messages(bot, chat_id: int, message_ids) -> int:
+    message_ids = list(message_ids)
+    if bulk_delete_messages(bot, chat_id, message_ids):
+        return len(message_ids)
+
+    def delete_one(message_id):
+        try:
+            bot.delete_message(chat_id=chat_id, message_id=message_id)
+            return True
+        except Exception as e:
+            logger.debug(f"Не удалось удалить сообщение {message_id} в чате {chat_id}: {e}")
+            return False
+    return sum(DELETE_EXECUTOR.map(delete_one, message_ids))
 
 # Обработчик кнопки удаления
 @restrict_access
@@ -1285,12 +1698,12 @@ def delete_message(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     try:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        logger.debug(f"Пользователь {user_display} вызвал delete_message с callback_data: {query.data}")
+        user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+        logger.debug("Пользователь %s вызвал delete_message с callback_data: %s", user_display, query.data)
         if query.data.startswith('delete_answer_'):
-            question_id = int(query.data.split('_')[-1])
+            question_id = int(query.data.rpartition('_')[2])
             if context.user_data.get('current_question_id') != question_id:
-                logger.warning(f"Пользователь {user_display} попытался удалить сообщения для неправильного question_id: {question_id}")
+                logger.warning("Пользователь %s попытался удалить сообщения для неправильного question_id: %s", user_display, question_id)
                 query.message.reply_text(
                     "❌ Сообщения для удаления не соответствуют текущему пункту!",
                     reply_markup=MAIN_MENU,
@@ -1299,7 +1712,7 @@ def delete_message(update: Update, context: CallbackContext):
                 return
             message_ids = context.user_data.get('answer_message_ids', [])
             if not message_ids:
-                logger.warning(f"Пользователь {user_display} попытался удалить сообщения, но answer_message_ids пуст")
+                logger.warning("Пользователь %s попытался удалить сообщения, но answer_message_ids пуст", user_display)
                 query.message.reply_text(
                     "❌ Сообщения для удаления не найдены!",
                     reply_markup=MAIN_MENU,
@@ -1307,14 +1720,7 @@ def delete_message(update: Update, context: CallbackContext):
                 )
                 return
             chat_id = query.message.chat_id
-            deleted_count = 0
-            for message_id in message_ids:
-                try:
-                    context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-                    logger.info(f"Пользователь {user_display} удалил сообщение {message_id} в чате {chat_id}")
-                    deleted_count += 1
-                except Exception as e:
-                    logger.debug(f"Не удалось удалить сообщение {message_id} в чате {chat_id}: {str(e)}")
+            deleted_count = delete_messages(context.bot, chat_id, message_ids)
             context.user_data['answer_message_ids'] = []
             context.user_data['current_question_id'] = None
             query.message.reply_text(
@@ -1322,151 +1728,35 @@ def delete_message(update: Update, context: CallbackContext):
                 reply_markup=MAIN_MENU,
                 quote=False
             )
-            logger.info(f"Пользователь {user_display} успешно удалил {deleted_count} сообщений")
+            logger.info("Пользователь %s успешно удалил %s сообщений", user_display, deleted_count)
         else:
-            logger.warning(f"Неверный callback_data в delete_message: {query.data}")
+            logger.warning("Неверный callback_data в delete_message: %s", query.data)
             query.message.reply_text(
                 "❌ Неверный запрос на удаление!",
                 reply_markup=MAIN_MENU,
                 quote=False
             )
     except Exception as e:
-        logger.error(f"Ошибка в delete_message для пользователя {user_display}: {str(e)}", exc_info=True)
+        logger.error("Ошибка в delete_message для пользователя %s: %s", user_display, e, exc_info=True)
         query.message.reply_text(
             "❌ Произошла ошибка при удалении сообщений. Попробуйте снова.",
             reply_markup=MAIN_MENU,
             quote=False
         )
 
-# Обработка фотографий для ответа
-@restrict_access
-def receive_answer(update: Update, context: CallbackContext):
-    if not context.user_data.get('conversation_active', False) or 'new_question' not in context.user_data:
-        logger.warning(f"Пользователь {update.effective_user.id} попытался отправить ответ без активного диалога или вопроса")
-        update.message.reply_text(
-            f"❌ Пожалуйста, начните добавление {'пункта' if context.user_data.get('data_type') == 'guide' else 'шаблона'} заново.",
-            reply_markup=MAIN_MENU,
-            quote=False
-        )
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'INVALID_ANSWER'
-        context.user_data['conversation_active'] = False
-        return ConversationHandler.END
-    data_type = context.user_data.get('data_type', 'guide')
-    if data_type not in ['guide', 'template']:
-        logger.error(f"Недопустимый data_type: {data_type}")
-        update.message.reply_text(
-            "❌ Ошибка: Неверный тип данных. Начните заново.",
-            reply_markup=MAIN_MENU,
-            quote=False
-        )
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'INVALID_DATA_TYPE'
-        context.user_data['conversation_active'] = False
-        return ConversationHandler.END
-    if 'photos' not in context.user_data:
-        context.user_data['photos'] = []
-    if 'documents' not in context.user_data:
-        context.user_data['documents'] = []
-    if 'pending_photos' not in context.user_data:
-        context.user_data['pending_photos'] = []
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-
-    if update.message.text == "Готово":
-        if context.user_data.get('pending_photos'):
-            unique_photos = list(dict.fromkeys(context.user_data['pending_photos']))
-            context.user_data['photos'].extend([pid for pid in unique_photos if pid not in context.user_data['photos']])
-            logger.info(f"Пользователь {user_display} добавил {len(unique_photos)} новых фото из pending_photos в {data_type}: {unique_photos}")
-            context.user_data['pending_photos'] = []
-        save_new_point(update, context, send_message=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = f'{data_type.upper()}_FILES_SAVED'
-        context.user_data['conversation_active'] = False
-        return ConversationHandler.END
-    elif update.message.photo:
-        if update.message.media_group_id:
-            context.user_data['media_group_id'] = update.message.media_group_id
-            context.user_data['pending_photos'].append(update.message.photo[-1].file_id)
-            context.user_data['last_photo_time'] = update.message.date
-            logger.info(f"Пользователь {user_display} добавил фото в альбом {data_type} media group {update.message.media_group_id}: {update.message.photo[-1].file_id}")
-            if len(context.user_data['pending_photos']) == 1:
-                loading_message = update.message.reply_text("⏳ Загрузка...", quote=False)
-                context.user_data['loading_message_id'] = loading_message.message_id
-                if not context.user_data.get('timeout_task'):
-                    context.user_data['timeout_task'] = context.job_queue.run_once(
-                        check_album_timeout, 7, context=(update, context)
-                    )
-            return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
-        else:
-            context.user_data['photos'] = [update.message.photo[-1].file_id]
-            logger.info(f"Пользователь {user_display} добавил одно фото в {data_type}: {context.user_data['photos']}")
-            update.message.reply_text(
-                f"✅ Фото добавлено ({len(context.user_data['photos'])}). Отправьте ещё файлы, текст или нажмите 'Готово':",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
-                quote=False
-            )
-        if update.message.caption and not context.user_data.get('answer'):
-            context.user_data['answer'] = update.message.caption
-        return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
-    elif update.message.document:
-        doc = update.message.document
-        if doc.mime_type not in [
-            'application/msword',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'application/pdf',
-            'application/vnd.ms-excel',
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        ]:
-            update.message.reply_text(
-                "❌ Поддерживаются только файлы .doc, .docx, .pdf, .xls, .xlsx!",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
-                quote=False
-            )
-            return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
-        if doc.file_size > 20 * 1024 * 1024:
-            update.message.reply_text(
-                "❌ Файл слишком большой! Максимальный размер — 20 МБ.",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
-                quote=False
-            )
-            return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
-        if doc.file_id not in context.user_data['documents']:
-            context.user_data['documents'].append(doc.file_id)
-            logger.info(f"Пользователь {user_display} добавил документ в {data_type}: {doc.file_id}")
-            if update.message.caption and not context.user_data.get('answer'):
-                context.user_data['answer'] = update.message.caption
-            update.message.reply_text(
-                f"✅ Документ добавлен ({len(context.user_data['documents'])}). Отправьте ещё файлы, текст или нажмите 'Готово':",
-                reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
-                quote=False
-            )
-    else:
-        context.user_data['answer'] = update.message.text
-        update.message.reply_text(
-            f"✅ Ответ сохранён. Отправьте ещё файлы или нажмите 'Готово':",
-            reply_markup=ReplyKeyboardMarkup([["Готово"], ["/cancel"]], resize_keyboard=True),
-            quote=False
-        )
-    return GUIDE_ANSWER_PHOTOS if data_type == 'guide' else TEMPLATE_ANSWER_PHOTOS
-
 # Редактирование пункта справочника
 @restrict_access
+@log_action('edit_point', 'Пользователь начал редактирование пункта справочника')
 def edit_point(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     logger.info(f"Пользователь {user_display} начал редактирование пункта справочника")
-    # Запись действия с никнеймом
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",
-        'action': 'edit_point',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь начал редактирование пункта справочника'
-    })
     # Остальной код без изменений
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'EDIT_GUIDE'
-    context.user_data['conversation_active'] = True
-    context.user_data['data_type'] = 'guide'
+    reset_user_data(
+        context.user_data,
+        conversation_state='EDIT_GUIDE',
+        conversation_active=True,
+        data_type='guide'
+    )
     try:
         guide = load_guide()
         if not guide["questions"]:
@@ -1483,9 +1773,7 @@ def edit_point(update: Update, context: CallbackContext):
         return GUIDE_EDIT_QUESTION
     except Exception as e:
         logger.error(f"Ошибка в edit_point для пользователя {user_display}: {e}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
+        reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
         update.message.reply_text(
             "❌ Ошибка при редактировании пункта. Попробуйте снова.",
             reply_markup=MAIN_MENU,
@@ -1497,10 +1785,12 @@ def edit_point(update: Update, context: CallbackContext):
 @restrict_access
 def edit_template(update: Update, context: CallbackContext):
     logger.info(f"Пользователь {update.effective_user.id} начал редактирование шаблона")
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'EDIT_TEMPLATE'
-    context.user_data['conversation_active'] = True
-    context.user_data['data_type'] = 'template'
+    reset_user_data(
+        context.user_data,
+        conversation_state='EDIT_TEMPLATE',
+        conversation_active=True,
+        data_type='template'
+    )
     try:
         templates = load_templates()
         if not templates["templates"]:
@@ -1524,9 +1814,7 @@ def edit_template(update: Update, context: CallbackContext):
         return TEMPLATE_EDIT_QUESTION
     except Exception as e:
         logger.error(f"Ошибка в edit_template для пользователя {update.effective_user.id}: {e}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
+        reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
         if update.message:
             update.message.reply_text(
                 "❌ Ошибка при редактировании шаблона. Попробуйте снова.",
@@ -1543,6 +1831,7 @@ def edit_template(update: Update, context: CallbackContext):
 
 # Отображение страницы редактирования справочника
 def display_guide_edit_page(update: Update, context: CallbackContext, data, page):
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     try:
         ITEMS_PER_PAGE = 15
         total_items = len(data["questions"])
@@ -1556,15 +1845,15 @@ def display_guide_edit_page(update: Update, context: CallbackContext, data, page
         end_idx = min(start_idx + ITEMS_PER_PAGE, total_items)
         items = data["questions"][start_idx:end_idx]
 
-        keyboard = []
-        for item in items:
-            if not isinstance(item, dict) or "question" not in item or "id" not in item:
-                logger.error(f"Неверные данные справочника: {item}")
-                continue
-            question_text = item["question"][:100] if len(item["question"]) > 100 else item["question"]
-            callback_data = f'edit_guide_question_{item["id"]}'
-            logger.info(f"Сформирована кнопка редактирования: callback_data={callback_data}, вопрос={question_text}")
-            keyboard.append([InlineKeyboardButton(f"📄 {question_text}", callback_data=callback_data)])
+        items_valid = [it for it in items if isinstance(it, dict) and "question" in it and "id" in it]
+        if len(items_valid) != len(items):
+            logger.error("Неверные данные справочника на странице %s: пропущено %s записей", page + 1, len(items) - len(items_valid))
+        keyboard = [
+            [InlineKeyboardButton(f"📄 {it['question'][:100]}", callback_data=f'edit_guide_question_{it["id"]}')]
+            for it in items_valid
+        ]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Сформировано %s кнопок редактирования справочника: %s", len(keyboard), [it["id"] for it in items_valid])
 
         nav_buttons = []
         if page > 0:
@@ -1576,7 +1865,6 @@ def display_guide_edit_page(update: Update, context: CallbackContext, data, page
 
         reply_markup = InlineKeyboardMarkup(keyboard)
         text = f"✏️ Выберите вопрос для редактирования (страница {page + 1}/{total_pages}):"
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
 
         if update.message:
             message = update.message.reply_text(text, reply_markup=reply_markup, quote=False)
@@ -1603,15 +1891,12 @@ def display_guide_edit_page(update: Update, context: CallbackContext, data, page
                 context=None
             )
 
-        logger.info(f"Пользователь {user_display} просмотрел страницу редактирования справочника {page + 1}")
+        logger.debug("Пользователь %s просмотрел страницу редактирования справочника %s", user_display, page + 1)
         context.user_data['conversation_state'] = 'EDIT_GUIDE_PAGE'
         return GUIDE_EDIT_QUESTION
     except Exception as e:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
         logger.error(f"Ошибка в display_guide_edit_page для пользователя {user_display}: {str(e)}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
+        reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
         if update.message:
             update.message.reply_text(
                 "❌ Ошибка при отображении страницы редактирования. Попробуйте снова.",
@@ -1628,6 +1913,7 @@ def display_guide_edit_page(update: Update, context: CallbackContext, data, page
 
 # Отображение страницы редактирования шаблонов
 def display_template_edit_page(update: Update, context: CallbackContext, data, page):
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     try:
         ITEMS_PER_PAGE = 15
         total_items = len(data["templates"])
@@ -1641,15 +1927,15 @@ def display_template_edit_page(update: Update, context: CallbackContext, data, p
         end_idx = min(start_idx + ITEMS_PER_PAGE, total_items)
         items = data["templates"][start_idx:end_idx]
 
-        keyboard = []
-        for item in items:
-            if not isinstance(item, dict) or "question" not in item or "id" not in item:
-                logger.error(f"Неверные данные шаблона: {item}")
-                continue
-            question_text = item["question"][:100] if len(item["question"]) > 100 else item["question"]
-            callback_data = f'edit_template_question_{item["id"]}'
-            logger.info(f"Сформирована кнопка редактирования: callback_data={callback_data}, вопрос={question_text}")
-            keyboard.append([InlineKeyboardButton(f"📄 {question_text}", callback_data=callback_data)])
+        items_valid = [it for it in items if isinstance(it, dict) and "question" in it and "id" in it]
+        if len(items_valid) != len(items):
+            logger.error("Неверные данные шаблона на странице %s: пропущено %s записей", page + 1, len(items) - len(items_valid))
+        keyboard = [
+            [InlineKeyboardButton(f"📄 {it['question'][:100]}", callback_data=f'edit_template_question_{it["id"]}')]
+            for it in items_valid
+        ]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Сформировано %s кнопок редактирования шаблона: %s", len(keyboard), [it["id"] for it in items_valid])
 
         nav_buttons = []
         if page > 0:
@@ -1661,7 +1947,6 @@ def display_template_edit_page(update: Update, context: CallbackContext, data, p
 
         reply_markup = InlineKeyboardMarkup(keyboard)
         text = f"✏️ Выберите шаблон для редактирования (страница {page + 1}/{total_pages}):"
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
 
         if update.message:
             message = update.message.reply_text(text, reply_markup=reply_markup, quote=False)
@@ -1688,15 +1973,12 @@ def display_template_edit_page(update: Update, context: CallbackContext, data, p
                 context=None
             )
 
-        logger.info(f"Пользователь {user_display} просмотрел страницу редактирования шаблонов {page + 1}")
+        logger.debug("Пользователь %s просмотрел страницу редактирования шаблонов %s", user_display, page + 1)
         context.user_data['conversation_state'] = 'EDIT_TEMPLATE_PAGE'
         return TEMPLATE_EDIT_QUESTION
     except Exception as e:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
         logger.error(f"Ошибка в display_template_edit_page для пользователя {user_display}: {str(e)}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
+        reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
         if update.message:
             update.message.reply_text(
                 "❌ Ошибка при отображении страницы редактирования. Попробуйте снова.",
@@ -1717,20 +1999,24 @@ def handle_edit_pagination(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     try:
-        data_type = query.data.split('_')[1]
+        action, data_type, kind, arg = EDIT_CALLBACK_RE.match(query.data).groups()
         logger.info(f"Пользователь {update.effective_user.id} в handle_edit_pagination, callback_data: {query.data}")
-        if query.data == f'cancel_{data_type}_edit':
-            context.user_data.clear()
-            context.user_data['conversation_state'] = f'CANCEL_{data_type.upper()}_EDIT'
-            context.user_data['conversation_active'] = False
+        if action == 'cancel':
+            reset_user_data(
+                context.user_data,
+                conversation_state=f'CANCEL_{data_type.upper()}_EDIT',
+                conversation_active=False
+            )
             query.message.reply_text(
                 f"🚪 Редактирование {'пункта' if data_type == 'guide' else 'шаблона'} отменено.",
                 reply_markup=MAIN_MENU,
                 quote=False
             )
             return ConversationHandler.END
-        page = int(query.data.split('_')[3])
-        data = context.user_data.get('data', load_data(data_type))
+        page = int(arg)
+        data = context.user_data.get('data')
+        if data is None:
+            data = load_data(data_type)
         if data_type == 'guide':
             display_guide_edit_page(update, context, data, page)
             return GUIDE_EDIT_QUESTION
@@ -1739,9 +2025,7 @@ def handle_edit_pagination(update: Update, context: CallbackContext):
             return TEMPLATE_EDIT_QUESTION
     except Exception as e:
         logger.error(f"Ошибка в handle_edit_pagination для пользователя {update.effective_user.id}: {e}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
+        reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
         query.message.reply_text(
             "❌ Ошибка при переключении страницы редактирования. Попробуйте снова.",
             reply_markup=MAIN_MENU,
@@ -1749,6 +2033,20 @@ def handle_edit_pagination(update: Update, context: CallbackContext):
         )
         return ConversationHandler.END
 
+# Меню выбора поля для редактирования (не зависит от пункта, создаётся один раз на тип данных)
+def build_edit_field_menu(data_type: str) -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton("Изменить вопрос", callback_data=f'edit_{data_type}_field_question')],
+        [InlineKeyboardButton("Изменить ответ", callback_data=f'edit_{data_type}_field_answer')],
+        [InlineKeyboardButton("Удалить пункт", callback_data=f'edit_{data_type}_field_delete')],
+    ]
+    if ENABLE_PHOTOS:
+        keyboard.insert(2, [InlineKeyboardButton("Добавить/изменить фото", callback_data=f'edit_{data_type}_field_photo')])
+    keyboard.append([InlineKeyboardButton("🚪 Отмена", callback_data=f'cancel_{data_type}_edit')])
+    return InlineKeyboardMarkup(keyboard)
+
+EDIT_FIELD_MENUS = {data_type: build_edit_field_menu(data_type) for data_type in ('guide', 'template')}
+
 # Выбор вопроса для редактирования
 @restrict_access
 def select_edit_question(update: Update, context: CallbackContext):
@@ -1756,31 +2054,20 @@ def select_edit_question(update: Update, context: CallbackContext):
     query.answer()
     try:
         logger.info(f"Пользователь {update.effective_user.id} вошел в select_edit_question с callback_data: {query.data}")
-        data_type = query.data.split('_')[1]
-        question_id = int(query.data.split('_')[3])
+        action, data_type, kind, arg = EDIT_CALLBACK_RE.match(query.data).groups()
+        question_id = int(arg)
         context.user_data['edit_question_id'] = question_id
         logger.info(f"Пользователь {update.effective_user.id} выбрал для редактирования {data_type} ID {question_id}")
         context.user_data['conversation_state'] = f'SELECT_EDIT_{data_type.upper()}_QUESTION'
-        keyboard = [
-            [InlineKeyboardButton("Изменить вопрос", callback_data=f'edit_{data_type}_field_question')],
-            [InlineKeyboardButton("Изменить ответ", callback_data=f'edit_{data_type}_field_answer')],
-            [InlineKeyboardButton("Удалить пункт", callback_data=f'edit_{data_type}_field_delete')],
-        ]
-        if ENABLE_PHOTOS:
-            keyboard.insert(2, [InlineKeyboardButton("Добавить/изменить фото", callback_data=f'edit_{data_type}_field_photo')])
-        keyboard.append([InlineKeyboardButton("🚪 Отмена", callback_data=f'cancel_{data_type}_edit')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
         query.message.edit_text(
             f"✏️ Что хотите изменить в {'вопросе' if data_type == 'guide' else 'шаблоне'}?",
-            reply_markup=reply_markup
+            reply_markup=EDIT_FIELD_MENUS[data_type]
         )
         logger.info(f"Пользователь {update.effective_user.id} перешел в состояние {'GUIDE_EDIT_FIELD' if data_type == 'guide' else 'TEMPLATE_EDIT_FIELD'}")
         return GUIDE_EDIT_FIELD if data_type == 'guide' else TEMPLATE_EDIT_FIELD
     except Exception as e:
         logger.error(f"Ошибка в select_edit_question для пользователя {update.effective_user.id}: {e}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
+        reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
         query.message.reply_text(
             "❌ Ошибка при выборе пункта для редактирования. Попробуйте снова.",
             reply_markup=MAIN_MENU,
@@ -1794,30 +2081,44 @@ def receive_edit_field(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     try:
-        data_type = query.data.split('_')[1]
+        action, data_type, kind, field_kind = EDIT_CALLBACK_RE.match(query.data).groups()
         logger.info(f"Пользователь {update.effective_user.id} вошел в receive_edit_field с callback_data: {query.data}")
-        if query.data == f'cancel_{data_type}_edit':
-            context.user_data.clear()
-            context.user_data['conversation_state'] = f'CANCEL_{data_type.upper()}_EDIT'
-            context.user_data['conversation_active'] = False
+        if action == 'cancel':
+            reset_user_data(
+                context.user_data,
+                conversation_state=f'CANCEL_{data_type.upper()}_EDIT',
+                conversation_active=False
+            )
             query.message.reply_text(
                 f"🚪 Редактирование {'пункта' if data_type == 'guide' else 'шаблона'} отменено.",
                 reply_markup=MAIN_MENU,
                 quote=False
             )
             return ConversationHandler.END
-        context.user_data['edit_field'] = query.data
+        context.user_data['edit_field_kind'] = field_kind  # 'question' | 'answer' | 'photo'
         logger.info(f"Пользователь {update.effective_user.id} выбрал поле для редактирования {data_type}: {query.data}")
         context.user_data['conversation_state'] = f'RECEIVE_{data_type.upper()}_EDIT_FIELD'
-        if query.data == f'edit_{data_type}_field_delete':
+        if field_kind == 'delete':
             data = load_data(data_type)
             key = 'questions' if data_type == 'guide' else 'templates'
             question_id = context.user_data['edit_question_id']
-            data[key] = [q for q in data[key] if q["id"] != question_id]
+            item = get_id_index(data_type, data).get(question_id)
+            if item is None:
+                # Пункт уже удалён или список редактирования устарел
+                query.message.reply_text(
+                    "❌ Пункт не найден!",
+                    reply_markup=MAIN_MENU,
+                    quote=False
+                )
+                reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
+                return ConversationHandler.END
+            data[key].remove(item)
             save_data(data_type, data)
-            context.user_data.clear()
-            context.user_data['conversation_state'] = f'{data_type.upper()}_POINT_DELETED'
-            context.user_data['conversation_active'] = False
+            reset_user_data(
+                context.user_data,
+                conversation_state=f'{data_type.upper()}_POINT_DELETED',
+                conversation_active=False
+            )
             query.message.reply_text(
                 f"🗑️ {'Пункт' if data_type == 'guide' else 'Шаблон'} удалён!",
                 reply_markup=MAIN_MENU,
@@ -1826,41 +2127,37 @@ def receive_edit_field(update: Update, context: CallbackContext):
             logger.info(f"Пользователь {update.effective_user.id} удалил {data_type} ID {question_id}")
             return ConversationHandler.END
         # Определяем поле и получаем текущее значение
-        field = "вопрос" if query.data == f'edit_{data_type}_field_question' else "ответ" if query.data == f'edit_{data_type}_field_answer' else "фото/альбом"
+        field = "вопрос" if field_kind == 'question' else "ответ" if field_kind == 'answer' else "фото/альбом"
         data = load_data(data_type)
         key = 'questions' if data_type == 'guide' else 'templates'
         question_id = context.user_data['edit_question_id']
-        item = next((q for q in data[key] if q["id"] == question_id), None)
+        item = get_id_index(data_type, data).get(question_id)
         if not item:
             query.message.reply_text(
                 "❌ Пункт не найден!",
                 reply_markup=MAIN_MENU,
                 quote=False
             )
-            context.user_data.clear()
-            context.user_data['conversation_state'] = 'ERROR'
-            context.user_data['conversation_active'] = False
+            reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
             return ConversationHandler.END
         current_value = ""
-        if query.data == f'edit_{data_type}_field_question':
+        if field_kind == 'question':
             current_value = f"Текущий вопрос: {item['question']}\n"
-        elif query.data == f'edit_{data_type}_field_answer':
+        elif field_kind == 'answer':
             current_value = f"Текущий ответ: {item.get('answer', 'Отсутствует')}\n"
-        elif query.data == f'edit_{data_type}_field_photo':
+        elif field_kind == 'photo':
             current_value = f"Текущие фото: {len(item.get('photos', []))} шт.\n"
         prompt = f"{current_value}✏️ Введите новый {field}:\n(Напишите /cancel для отмены)"
         query.message.reply_text(
             prompt,
-            reply_markup=ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True),
+            reply_markup=CANCEL_MENU,
             quote=False
         )
         logger.info(f"Пользователь {update.effective_user.id} перешел в состояние {'GUIDE_EDIT_VALUE' if data_type == 'guide' else 'TEMPLATE_EDIT_VALUE'}")
         return GUIDE_EDIT_VALUE if data_type == 'guide' else TEMPLATE_EDIT_VALUE
     except Exception as e:
         logger.error(f"Ошибка в receive_edit_field для пользователя {update.effective_user.id}: {e}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
+        reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
         query.message.reply_text(
             "❌ Ошибка при выборе поля для редактирования. Попробуйте снова.",
             reply_markup=MAIN_MENU,
@@ -1873,50 +2170,49 @@ def receive_edit_field(update: Update, context: CallbackContext):
 def receive_edit_value(update: Update, context: CallbackContext):
     data_type = context.user_data.get('data_type', 'guide')
     try:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        edit_field = context.user_data['edit_field']
-        field = "вопрос" if edit_field == f'edit_{data_type}_field_question' else "ответ" if edit_field == f'edit_{data_type}_field_answer' else "фото/документы"
+        user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+        field_kind = context.user_data['edit_field_kind']
+        field = "вопрос" if field_kind == 'question' else "ответ" if field_kind == 'answer' else "фото/документы"
         data = load_data(data_type)
         key = 'questions' if data_type == 'guide' else 'templates'
         question_id = context.user_data['edit_question_id']
-        item = next((q for q in data[key] if q["id"] == question_id), None)
+        item = get_id_index(data_type, data).get(question_id)
         if not item:
             update.message.reply_text(
                 "❌ Пункт не найден!",
                 reply_markup=MAIN_MENU,
                 quote=False
             )
-            context.user_data.clear()
-            context.user_data['conversation_state'] = 'ERROR'
-            context.user_data['conversation_active'] = False
+            reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
             return ConversationHandler.END
-        if edit_field == f'edit_{data_type}_field_question':
+        if field_kind == 'question':
             item['question'] = update.message.text
-        elif edit_field == f'edit_{data_type}_field_answer':
+        elif field_kind == 'answer':
             item['answer'] = update.message.text
-        elif edit_field == f'edit_{data_type}_field_photo':
+        elif field_kind == 'photo':
             if update.message.photo:
                 item['photos'] = [photo.file_id for photo in update.message.photo]
                 item['documents'] = []
             elif update.message.document:
                 doc = update.message.document
-                if doc.mime_type not in [
-                    'application/msword',
-                    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                    'application/pdf',
-                    'application/vnd.ms-excel',
-                    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                ]:
+                if doc.mime_type not in ALLOWED_DOC_MIMES:
                     update.message.reply_text(
                         "❌ Поддерживаются только файлы .doc, .docx, .pdf, .xls, .xlsx!",
-                        reply_markup=ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True),
+                        reply_markup=CANCEL_MENU,
                         quote=False
                     )
                     return GUIDE_EDIT_VALUE if data_type == 'guide' else TEMPLATE_EDIT_VALUE
-                if doc.file_size > 20 * 1024 * 1024:
+                if doc.file_size > MAX_DOC_BYTES:
                     update.message.reply_text(
                         "❌ Файл слишком большой! Максимальный размер — 20 МБ.",
-                        reply_markup=ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True),
+                        reply_markup=CANCEL_MENU,
+                        quote=False
+                    )
+                    return GUIDE_EDIT_VALUE if data_type == 'guide' else TEMPLATE_EDIT_VALUE
+                if not document_content_ok(context.bot, doc):
+                    update.message.reply_text(
+                        "❌ Содержимое файла не похоже на .doc, .docx, .pdf, .xls или .xlsx!",
+                        reply_markup=CANCEL_MENU,
                         quote=False
                     )
                     return GUIDE_EDIT_VALUE if data_type == 'guide' else TEMPLATE_EDIT_VALUE
@@ -1930,22 +2226,16 @@ def receive_edit_value(update: Update, context: CallbackContext):
         )
         logger.info(f"Пользователь {user_display} изменил {field} для {data_type} ID {question_id}")
         # Запись действия с никнеймом
-        context.bot_data['user_actions'].append({
-            'user_id': update.effective_user.id,
-            'username': update.effective_user.username or f"ID {update.effective_user.id}",
-            'action': 'edit_value',
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'details': f"Пользователь изменил {field} для {data_type} ID {question_id}"
-        })
-        context.user_data.clear()
-        context.user_data['conversation_state'] = f'{data_type.upper()}_EDITED'
-        context.user_data['conversation_active'] = False
+        record_action(context, update.effective_user, 'edit_value', f"Пользователь изменил {field} для {data_type} ID {question_id}")
+        reset_user_data(
+            context.user_data,
+            conversation_state=f'{data_type.upper()}_EDITED',
+            conversation_active=False
+        )
         return ConversationHandler.END
     except Exception as e:
         logger.error(f"Ошибка в receive_edit_value для пользователя {user_display}: {str(e)}", exc_info=True)
-        context.user_data.clear()
-        context.user_data['conversation_state'] = 'ERROR'
-        context.user_data['conversation_active'] = False
+        reset_user_data(context.user_data, conversation_state='ERROR', conversation_active=False)
         update.message.reply_text(
             "❌ Произошла ошибка при редактировании. Попробуйте снова.",
             reply_markup=MAIN_MENU,
@@ -1954,34 +2244,22 @@ def receive_edit_value(update: Update, context: CallbackContext):
         return ConversationHandler.END
 
 @restrict_access
+@log_action('start_zakupka', 'Пользователь начал поиск закупки')
 def start_zakupka(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     logger.info(f"Пользователь {user_display} начал поиск закупки по реестровому номеру")
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",
-        'action': 'start_zakupka',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь начал поиск закупки'
-    })
     update.message.reply_text(
         "Введите реестровый номер закупки (например, 31705311113):\n(Напишите /cancel для отмены)",
-        reply_markup=ReplyKeyboardMarkup([["/cancel"]], resize_keyboard=True)
+        reply_markup=CANCEL_MENU
     )
     return STATE_ZAKUPKA
 
 @restrict_access
 def receive_zakupka(update: Update, context: CallbackContext):
     reg_number = update.message.text.strip()
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     logger.info(f"Пользователь {user_display} ввел реестровый номер: {reg_number}")
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",
-        'action': 'receive_zakupka',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': f"Поиск закупки по номеру {reg_number}"
-    })
+    record_action(context, update.effective_user, 'receive_zakupka', f"Поиск закупки по номеру {reg_number}")
 
     url = f"https://zakupki.gov.ru/epz/order/notice/printForm/viewXml?regNumber={reg_number}"
     proxy = os.getenv('HTTPS_PROXY')
@@ -2037,9 +2315,7 @@ def receive_zakupka(update: Update, context: CallbackContext):
 def handle_invalid_input(update: Update, context: CallbackContext):
     logger.warning(f"Пользователь {update.effective_user.id} отправил неподдерживаемый ввод в состоянии диалога: {context.user_data.get('conversation_state')}")
     data_type = context.user_data.get('data_type', 'guide')
-    context.user_data.clear()
-    context.user_data['conversation_state'] = 'INVALID_INPUT'
-    context.user_data['conversation_active'] = False
+    reset_user_data(context.user_data, conversation_state='INVALID_INPUT', conversation_active=False)
     update.message.reply_text(
         f"❌ Пожалуйста, отправьте текст или фото/альбом (для ответа/фото)!\n(Напишите /cancel для отмены)",
         reply_markup=MAIN_MENU,
@@ -2047,66 +2323,52 @@ def handle_invalid_input(update: Update, context: CallbackContext):
     )
     return ConversationHandler.END
 
+# Текст инструкции (/instruction)
+INSTRUCTION_TEXT = (
+    "📜 **Инструкция по использованию бота**\n\n"
+    "Этот бот помогает работать со справочником и шаблонами ответов. Вот как пользоваться его функциями:\n\n"
+    "1. **📖 Справочник**:\n"
+    "   - Выберите эту кнопку, чтобы просмотреть вопросы и ответы.\n"
+    "   - Используйте кнопки пагинации (⬅️ Назад / Вперёд ➡️) для навигации.\n"
+    "   - Нажмите на вопрос, чтобы увидеть ответ. Ответы автоматически удаляются через 30 минут.\n"
+    "   - Для поиска введите ключевое слово в чат, и бот покажет подходящие вопросы.\n\n"
+    "2. **📋 Шаблоны ответов**:\n"
+    "   - Просматривайте готовые шаблоны для быстрых ответов.\n"
+    "   - Выберите шаблон, чтобы скопировать его текст или просмотреть вложения.\n\n"
+    "3. **➕ Добавить пункт**:\n"
+    "   - Добавляйте новые вопросы и ответы в справочник.\n"
+    "   - Введите вопрос, затем ответ. Можно прикрепить фото или документы (.doc, .docx, .pdf, .xls, .xlsx, до 20 МБ).\n"
+    "   - Нажмите 'Готово', чтобы сохранить, или /cancel для отмены.\n\n"
+    "4. **✏️ Редактировать пункт**:\n"
+    "   - Выберите вопрос для редактирования.\n"
+    "   - Изменяйте вопрос, ответ, фото или удаляйте пункт.\n"
+    "   - Следуйте подсказкам и завершайте редактирование или отменяйте через /cancel.\n\n"
+    "5. **🔍 Поиск по ИНН**:\n"
+    "   - Используйте команду /inn, чтобы найти организацию по ИНН.\n"
+    "   - Введите ИНН, и бот покажет название, адрес, директора, статус и другие данные.\n"
+    "   - Используйте /cancel для отмены поиска.\n\n"
+    "6. **📜 Инструкция**:\n"
+    "   - Вы здесь! Эта команда показывает, как пользоваться ботом.\n\n"
+    "7. **Дополнительно**:\n"
+    "   - Используйте /cancel в любой момент, чтобы отменить текущую операцию.\n"
+    "   - Для поиска просто введите ключевое слово в чат.\n"
+    "   - Если возникла ошибка, бот уведомит вас, и вы сможете начать заново.\n\n"
+    "Если что-то не работает, свяжитесь с администратором. Удачи! 🚀"
+)
+
 # Показать инструкцию по использованию бота
 @restrict_access
+@log_action('show_instruction', 'Пользователь открыл инструкцию')
 def show_instruction(update: Update, context: CallbackContext):
-    user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
+    user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
     logger.info(f"Пользователь {user_display} запросил инструкцию")
 
-    # Запись действия с никнеймом
-    context.bot_data['user_actions'].append({
-        'user_id': update.effective_user.id,
-        'username': update.effective_user.username or f"ID {update.effective_user.id}",
-        'action': 'show_instruction',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'details': 'Пользователь открыл инструкцию'
-    })
-
-    instruction_text = (
-        "📜 **Инструкция по использованию бота**\n\n"
-        "Этот бот помогает работать со справочником и шаблонами ответов. Вот как пользоваться его функциями:\n\n"
-        "1. **📖 Справочник**:\n"
-        "   - Выберите эту кнопку, чтобы просмотреть вопросы и ответы.\n"
-        "   - Используйте кнопки пагинации (⬅️ Назад / Вперёд ➡️) для навигации.\n"
-        "   - Нажмите на вопрос, чтобы увидеть ответ. Ответы автоматически удаляются через 30 минут.\n"
-        "   - Для поиска введите ключевое слово в чат, и бот покажет подходящие вопросы.\n\n"
-        "2. **📋 Шаблоны ответов**:\n"
-        "   - Просматривайте готовые шаблоны для быстрых ответов.\n"
-        "   - Выберите шаблон, чтобы скопировать его текст или просмотреть вложения.\n\n"
-        "3. **➕ Добавить пункт**:\n"
-        "   - Добавляйте новые вопросы и ответы в справочник.\n"
-        "   - Введите вопрос, затем ответ. Можно прикрепить фото или документы (.doc, .docx, .pdf, .xls, .xlsx, до 20 МБ).\n"
-        "   - Нажмите 'Готово', чтобы сохранить, или /cancel для отмены.\n\n"
-        "4. **✏️ Редактировать пункт**:\n"
-        "   - Выберите вопрос для редактирования.\n"
-        "   - Изменяйте вопрос, ответ, фото или удаляйте пункт.\n"
-        "   - Следуйте подсказкам и завершайте редактирование или отменяйте через /cancel.\n\n"
-        "5. **🔍 Поиск по ИНН**:\n"
-        "   - Используйте команду /inn, чтобы найти организацию по ИНН.\n"
-        "   - Введите ИНН, и бот покажет название, адрес, директора, статус и другие данные.\n"
-        "   - Используйте /cancel для отмены поиска.\n\n"
-        "6. **📜 Инструкция**:\n"
-        "   - Вы здесь! Эта команда показывает, как пользоваться ботом.\n\n"
-        "7. **Дополнительно**:\n"
-        "   - Используйте /cancel в любой момент, чтобы отменить текущую операцию.\n"
-        "   - Для поиска просто введите ключевое слово в чат.\n"
-        "   - Если возникла ошибка, бот уведомит вас, и вы сможете начать заново.\n\n"
-        "Если что-то не работает, свяжитесь с администратором. Удачи! 🚀"
-    )
-
-    try:
-        update.message.delete()  # Удаляем команду /instruction
-    except Exception as e:
-        logger.debug(f"Не удалось удалить сообщение команды /instruction от {user_display}: {e}")
+    delete_user_message(update.message, user_display, "сообщение команды /instruction")
 
-    context.job_queue.run_once(
-        lambda ctx: clear_chat(ctx, update.effective_chat.id, update.effective_message.message_id, user_display),
-        0,
-        context=None
-    )
+    context.dispatcher.run_async(clear_chat, context, update.effective_chat.id, update.effective_message.message_id, user_display)
 
     update.message.reply_text(
-        instruction_text,
+        INSTRUCTION_TEXT,
         reply_markup=MAIN_MENU,
         parse_mode="Markdown"
     )
@@ -2331,8 +2593,7 @@ def receive_inn(update: Update, context: CallbackContext):
 
 
 def cancel_inn(update: Update, context: CallbackContext):
-    context.user_data.clear()
-    context.user_data['conversation_active'] = False
+    reset_user_data(context.user_data, conversation_active=False)
     update.message.reply_text("Поиск по ИНН отменён.")
     return ConversationHandler.END
 
@@ -2340,62 +2601,119 @@ def cancel_inn(update: Update, context: CallbackContext):
 def handle_menu_in_inn_state(update: Update, context: CallbackContext):
        text = update.message.text
        cancel_inn(update, context)  # Отменяем состояние /inn
-       if text == "📖 Справочник":
-           open_guide(update, context)
-       elif text == "📋 Шаблоны ответов":
-           open_templates(update, context)
-       elif text == "➕ Добавить пункт":
-           add_point(update, context)
-       elif text == "✏️ Редактировать пункт":
-           edit_point(update, context)
+       handler = MENU_HANDLERS.get(text)
+       if handler:
+           handler(update, context)
        return ConversationHandler.END
 # --- конец блока /inn ---
 
 
+# Рабочие потоки диспетчера для обработчиков с run_async=True. Обработчики в основном
+# ждут ответа Bot API, поэтому потоков больше, чем стандартные 4 в PTB 13
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "16"))
+
+# Соединений к Bot API: рабочие потоки диспетчера, очередь задач, DELETE_EXECUTOR и запас.
+# Если пул меньше числа одновременных запросов, urllib3 открывает и выбрасывает лишние
+# соединения, и каждый такой запрос заново проходит TLS-рукопожатие
+BOT_CON_POOL_SIZE = BOT_WORKERS + 16
+# Таймауты Bot API: стандартных 5 секунд на чтение не хватает на отправку альбомов и документов,
+# а оборванный по таймауту запрос даёт TimedOut и закрывает соединение из пула
+BOT_CONNECT_TIMEOUT = 10
+BOT_READ_TIMEOUT = 30
+
+# Webhook вместо long polling: если задан WEBHOOK_URL, Telegram сам присылает апдейты
+# на встроенный HTTP-сервер PTB (за обратным прокси с TLS). WEBHOOK_URL — публичный
+# базовый адрес, апдейты принимаются на пути WEBHOOK_URL/<BOT_TOKEN>
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+
+# Команды бургер-меню
+BOT_COMMANDS = (
+    BotCommand("start", "Запустить бота"),
+    BotCommand("stats", "Показать статистику (для администратора)"),
+    BotCommand("instruction", "Показать инструкцию по использованию бота"),
+    BotCommand("inn", "Поиск организации по ИНН"),
+    BotCommand("zakupka", "Поиск закупки по реестровому номеру"),
+)
+
+# Обработчики кнопок главного меню для route_text_message
+MENU_HANDLERS = {
+    '📖 Справочник': open_guide,
+    '📋 Шаблоны ответов': open_templates,
+    '➕ Добавить пункт': add_point,
+    '✏️ Редактировать пункт': edit_point,
+}
 
 #Запуск бота
 def main():
-    updater = Updater(os.getenv("BOT_TOKEN"), use_context=True)
+    updater = Updater(
+        os.getenv("BOT_TOKEN"),
+        use_context=True,
+        workers=BOT_WORKERS,
+        request_kwargs={
+            'con_pool_size': BOT_CON_POOL_SIZE,
+            'connect_timeout': BOT_CONNECT_TIMEOUT,
+            'read_timeout': BOT_READ_TIMEOUT,
+        }
+    )
     dp = updater.dispatcher
     dp.add_error_handler(error_handler)
 
     # Инициализация структуры для статистики
     if 'user_actions' not in dp.bot_data:
-        dp.bot_data['user_actions'] = []
+        dp.bot_data['user_actions'] = deque(maxlen=MAX_USER_ACTIONS)
         logger.info("Инициализирована структура user_actions в bot_data")
     else:
-        # Очистка записей без username
-        old_count = len(dp.bot_data['user_actions'])
-        dp.bot_data['user_actions'] = [action for action in dp.bot_data['user_actions'] if 'username' in action]
-        logger.info(f"Очищены старые записи user_actions, удалено {old_count - len(dp.bot_data['user_actions'])} записей, осталось {len(dp.bot_data['user_actions'])}")
-
-    # Настройка планировщика
-    scheduler = BackgroundScheduler(timezone="UTC")
-    scheduler.add_job(
-        send_usage_stats,
-        'interval',
-        hours=6,
-        next_run_time=datetime.now(timezone.utc),
-        args=[dp]
+        # Очистка записей без username на месте: один проход по кругу, без копии очереди
+        actions = dp.bot_data['user_actions']
+        if not isinstance(actions, deque):  # список из старой версии бота
+            actions = dp.bot_data['user_actions'] = deque(actions, maxlen=MAX_USER_ACTIONS)
+        old_count = len(actions)
+        for _ in range(old_count):
+            action = actions.popleft()
+            if 'username' in action:
+                actions.append(action)
+        logger.info(f"Очищены старые записи user_actions, удалено {old_count - len(actions)} записей, осталось {len(actions)}")
+    threading.Thread(target=drain_user_actions, name='user-actions', daemon=True).start()
+    threading.Thread(target=git_sync_worker, name='git-sync', daemon=True).start()
+
+    # Статистика каждые 6 часов через JobQueue бота (отдельный планировщик не нужен);
+    # отчёт собирается в пуле потоков диспетчера, поток очереди задач не ждёт отправки
+    updater.job_queue.run_repeating(
+        lambda ctx: ctx.dispatcher.run_async(send_usage_stats, ctx),
+        interval=timedelta(hours=6),
+        first=0,
+        name='usage_stats'
     )
-    scheduler.start()
-    logger.info("Планировщик запущен для отправки статистики каждые 6 часов")
-
-    # НОВОЕ: Настройка списка команд для отображения в бургер-меню
-    from telegram import BotCommand
-    commands = [
-        BotCommand("start", "Запустить бота"),
-        BotCommand("stats", "Показать статистику (для администратора)"),
-        BotCommand("instruction", "Показать инструкцию по использованию бота"),
-        BotCommand("inn", "Поиск организации по ИНН"),
-        BotCommand("zakupka", "Поиск закупки по реестровому номеру")
-    ]
-    updater.bot.set_my_commands(commands)
-    logger.info("Команды бота настроены для отображения в меню")
+    logger.info("Задача отправки статистики каждые 6 часов запланирована")
+
+    updater.job_queue.run_repeating(
+        flush_user_actions,
+        interval=USER_ACTIONS_FLUSH_INTERVAL,
+        first=USER_ACTIONS_FLUSH_INTERVAL
+    )
+
+    # Список команд в бургер-меню обновляется, только если он изменился
+    try:
+        current_commands = [(c.command, c.description) for c in updater.bot.get_my_commands()]
+    except Exception as e:
+        logger.warning(f"Не удалось получить текущие команды бота: {e}")
+        current_commands = None
+    if current_commands != [(c.command, c.description) for c in BOT_COMMANDS]:
+        updater.bot.set_my_commands(BOT_COMMANDS)
+        logger.info("Команды бота настроены для отображения в меню")
+    else:
+        logger.info("Команды бота не изменились")
+
+    # Фильтры кнопок меню: один объект на кнопку для всех обработчиков
+    menu_filter = Filters.regex(MENU_BUTTONS_RE)
+    add_point_filter = Filters.regex(ADD_POINT_BUTTON_RE)
+    edit_point_filter = Filters.regex(EDIT_POINT_BUTTON_RE)
 
     # Регистрация ConversationHandler'ов
     guide_add_conv = ConversationHandler(
-        entry_points=[MessageHandler(Filters.regex(r'^➕ Добавить пункт$'), add_point)],
+        entry_points=[MessageHandler(add_point_filter, add_point)],
         states={
             GUIDE_QUESTION: [
                 MessageHandler(Filters.text & ~Filters.command, receive_question),
@@ -2410,11 +2728,13 @@ def main():
                 MessageHandler(Filters.text & ~Filters.command, receive_answer),
                 MessageHandler(~(Filters.text | Filters.photo | Filters.document) & ~Filters.command, handle_invalid_input),
             ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_user=True,
         per_chat=True,
         allow_reentry=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     template_add_conv = ConversationHandler(
@@ -2433,15 +2753,17 @@ def main():
                 MessageHandler(Filters.text & ~Filters.command, receive_answer),
                 MessageHandler(~(Filters.text | Filters.photo | Filters.document) & ~Filters.command, handle_invalid_input),
             ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_user=True,
         per_chat=True,
         allow_reentry=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     guide_edit_conv = ConversationHandler(
-        entry_points=[MessageHandler(Filters.regex(r'^✏️ Редактировать пункт$'), edit_point)],
+        entry_points=[MessageHandler(edit_point_filter, edit_point)],
         states={
             GUIDE_EDIT_QUESTION: [
                 CallbackQueryHandler(select_edit_question, pattern=r'^edit_guide_question_\d+$'),
@@ -2455,12 +2777,14 @@ def main():
                 MessageHandler(Filters.photo, receive_edit_value) if ENABLE_PHOTOS else None,
                 MessageHandler(~(Filters.text | Filters.photo) & ~Filters.command, handle_invalid_input),
             ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_user=True,
         per_chat=True,
         per_message=False,
         allow_reentry=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     template_edit_conv = ConversationHandler(
@@ -2478,12 +2802,14 @@ def main():
                 MessageHandler(Filters.photo, receive_edit_value) if ENABLE_PHOTOS else None,
                 MessageHandler(~(Filters.text | Filters.photo) & ~Filters.command, handle_invalid_input),
             ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_user=True,
         per_chat=True,
         per_message=False,
         allow_reentry=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     zakupka_conv = ConversationHandler(
@@ -2492,11 +2818,13 @@ def main():
             STATE_ZAKUPKA: [
                 MessageHandler(Filters.text & ~Filters.command, receive_zakupka)
             ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_user=True,
         per_chat=True,
         allow_reentry=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     dp.add_handler(zakupka_conv)
@@ -2507,13 +2835,13 @@ def main():
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler("cancel", cancel))
     dp.add_handler(CommandHandler("stats", stats_command))
-    dp.add_handler(CommandHandler("instruction", show_instruction)),
+    dp.add_handler(CommandHandler("instruction", serialize_per_chat(show_instruction), run_async=True)),
 
     conv_inn = ConversationHandler(
        entry_points=[CommandHandler("inn", start_inn)],
        states={STATE_INN: [
-           MessageHandler(Filters.text & ~Filters.command & ~Filters.regex(r'^(📖 Справочник|📋 Шаблоны ответов|➕ Добавить пункт|✏️ Редактировать пункт)$'), receive_inn),
-           MessageHandler(Filters.regex(r'^(📖 Справочник|📋 Шаблоны ответов|➕ Добавить пункт|✏️ Редактировать пункт)$'), handle_menu_in_inn_state)
+           MessageHandler(Filters.text & ~Filters.command & ~menu_filter, receive_inn),
+           MessageHandler(menu_filter, handle_menu_in_inn_state)
        ]},
        fallbacks=[
            CommandHandler("cancel", cancel_inn),
@@ -2523,23 +2851,37 @@ def main():
    )
     dp.add_handler(conv_inn)
 
-    dp.add_handler(MessageHandler(Filters.regex(r'^📖 Справочник$'), open_guide))
-    dp.add_handler(MessageHandler(Filters.regex(r'^📋 Шаблоны ответов$'), open_templates))
-    dp.add_handler(MessageHandler(Filters.regex(r'^➕ Добавить пункт$'), add_point))
-    dp.add_handler(MessageHandler(Filters.regex(r'^✏️ Редактировать пункт$'), edit_point))
+    # Обработчики только для чтения выполняются асинхронно (run_async), чтобы медленные
+    # запросы к Telegram в одном чате не задерживали обработку других чатов
     #dp.add_handler(MessageHandler(Filters.regex(r'^📕 223-ФЗ$'), open_fz223_guide))
     #dp.add_handler(MessageHandler(Filters.regex(r'^📗 44-ФЗ$'), open_fz44_guide))
-    dp.add_handler(CallbackQueryHandler(handle_pagination, pattern=r'^(guide|template)_page_\d+$'))
-    dp.add_handler(CallbackQueryHandler(show_answer, pattern=r'^(guide|template)_question_\d+$'))
+    dp.add_handler(CallbackQueryHandler(serialize_per_chat(handle_pagination), pattern=r'^P[gt]\d+$', run_async=True))
+    dp.add_handler(CallbackQueryHandler(serialize_per_chat(show_answer), pattern=r'^[gt]\d+$', run_async=True))
     dp.add_handler(CallbackQueryHandler(handle_template_action, pattern='^(add_template|edit_template|cancel_template)$'))
-    dp.add_handler(CallbackQueryHandler(delete_answer, pattern='^delete_answer$'))
+    dp.add_handler(CallbackQueryHandler(serialize_per_chat(delete_answer), pattern='^delete_answer$', run_async=True))
+    # Кнопки меню и поиск — один обработчик текста с выбором функции по словарю
     dp.add_handler(MessageHandler(
-        Filters.text & ~Filters.command & ~Filters.regex(r'^(📖 Справочник|📋 Шаблоны ответов|➕ Добавить пункт|✏️ Редактировать пункт)$'),
-        perform_search
+        Filters.text & ~Filters.command,
+        serialize_per_chat(route_text_message),
+        run_async=True
     ))
 
-    logger.info("Бот запущен...")
-    updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # В PTB 13 нет secret_token: принимать апдейты можно только на секретном пути,
+        # иначе любой, кто достучится до порта, подделает апдейт от разрешённого пользователя
+        token = os.getenv("BOT_TOKEN")
+        base_path = urlsplit(WEBHOOK_URL).path.strip('/')
+        updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=f"{base_path}/{token}" if base_path else token,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{token}",
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Бот запущен (webhook, порт {WEBHOOK_PORT})...")
+    else:
+        updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info("Бот запущен...")
     updater.idle()
 
 # Очистка чата (фоновая задача)
@@ -2547,13 +2889,20 @@ def clear_chat(context: CallbackContext, chat_id: int, message_id: int, user_dis
     try:
         logger.info(f"Пользователь {user_display} инициировал фоновую очистку чата {chat_id}")
         # Ограничиваем количество удаляемых сообщений до 50
+        message_ids = range(message_id - 1, max(message_id - 50, 1), -1)
+        if bulk_delete_messages(context.bot, chat_id, message_ids):
+            logger.info(f"Чат {chat_id} очищен пользователем {user_display} в фоновом режиме одним запросом ({len(message_ids)} сообщений)")
+            return
         deleted_count = 0
-        for i in range(message_id - 1, max(message_id - 50, 1), -1):
+        next_at = time.monotonic()
+        for i in message_ids:
             try:
                 context.bot.delete_message(chat_id=chat_id, message_id=i)
                 deleted_count += 1
-                # Задержка 0.2 секунды для соблюдения лимитов Telegram API
-                asyncio.run(asyncio.sleep(0.2))
+                # Не чаще CLEAR_CHAT_RATE удалений в секунду (лимиты Telegram API); время
+                # самого запроса засчитывается в интервал, а не добавляется к нему
+                next_at += 1 / CLEAR_CHAT_RATE
+                time.sleep(max(0.0, next_at - time.monotonic()))
             except Exception as e:
                 logger.debug(f"Не удалось удалить сообщение {i} в чате {chat_id}: {e}")
                 continue
@@ -2561,6 +2910,16 @@ def clear_chat(context: CallbackContext, chat_id: int, message_id: int, user_dis
     except Exception as e:
         logger.error(f"Ошибка при фоновой очистке чата {chat_id} для пользователя {user_display}: {e}", exc_info=True)
 
+# Удаление сообщения пользователя (команды или нажатой кнопки меню). Сообщения старше
+# MESSAGE_DELETE_MAX_AGE Telegram удалить не даст — запрос для них не отправляется
+def delete_user_message(message, user_display: str, what: str = "сообщение"):
+    if message is None or time.time() - message.date.timestamp() >= MESSAGE_DELETE_MAX_AGE:
+        return
+    try:
+        message.delete()
+    except Exception as e:
+        logger.debug("Не удалось удалить %s пользователя %s: %s", what, user_display, e)
+
 # Планирование автоматического удаления сообщения
 def schedule_message_deletion(context: CallbackContext):
     try:
@@ -2568,83 +2927,136 @@ def schedule_message_deletion(context: CallbackContext):
         chat_id = job_data['chat_id']
         message_ids = job_data['message_ids']
         user_display = job_data['user_display']
-        for message_id in message_ids:
-            try:
-                context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-                logger.info(f"Автоматически удалено сообщение {message_id} в чате {chat_id} для пользователя {user_display}")
-            except Exception as e:
-                logger.debug(f"Не удалось автоматически удалить сообщение {message_id} в чате {chat_id}: {e}")
+        # Все сообщения ответа одним вызовом deleteMessages, по одному — только при ошибке
+        # Сообщения, которые удалить нельзя, Telegram пропускает молча, поэтому в журнал
+        # пишется число запрошенных удалений, а не подтверждённых
+        delete_messages(context.bot, chat_id, message_ids)
+        logger.info("Запрошено автоудаление %s сообщений в чате %s для пользователя %s", len(message_ids), chat_id, user_display)
     except Exception as e:
         logger.error(f"Ошибка при автоматическом удалении сообщения для пользователя {user_display}: {e}", exc_info=True)
 
 
+# Склеивает строки в тексты не длиннее limit символов (разрыв только между строками;
+# слишком длинная строка обрезается)
+def iter_message_chunks(lines, limit: int = MAX_MESSAGE_LENGTH):
+    buf = io.StringIO()
+    size = 0
+    for line in lines:
+        line = line[:limit]
+        if size and size + 1 + len(line) > limit:
+            yield buf.getvalue()
+            buf = io.StringIO()
+            size = 0
+        if size:
+            buf.write("\n")
+            size += 1
+        buf.write(line)
+        size += len(line)
+    if size:
+        yield buf.getvalue()
+
 def send_usage_stats(context: CallbackContext):
     try:
-        actions = context.bot_data.get('user_actions', [])
-        if not actions:
+        # Действия лежат в порядке поступления: устаревшие снимаем слева, не копируя всю очередь
+        six_hours_ago = time.time() - 6 * 3600
+        actions = context.bot_data.get('user_actions') or deque()
+        expired = 0
+        while actions and action_epoch(actions[0]) < six_hours_ago:
+            actions.popleft()
+            expired += 1
+        if expired:
+            logger.info(f"Статистика очищена, удалено {expired} записей, осталось {len(actions)}")
+        # Снимок очереди: фоновый поток может дописывать в неё параллельно
+        recent_actions = list(actions)
+        if not recent_actions:
             context.bot.send_message(
-                chat_id=1250098712,
+                chat_id=STATS_CHAT_ID,
                 text="📊 Статистика за последние 6 часов: нет активности.",
                 parse_mode=None
             )
             logger.info("Статистика за последние 6 часов отсутствует")
             return
 
-        # Фильтрация действий за последние 6 часов
-        six_hours_ago = datetime.now(timezone.utc).timestamp() - 6 * 3600
-        recent_actions = [action for action in actions if datetime.fromisoformat(action['timestamp']).timestamp() >= six_hours_ago]
+        # Подсчёт статистики: Counter считает на C прямо из генераторов
+        # 'username' уже содержит готовое имя для показа (username или "ID ..."), см. record_action
+        action_counts = Counter(action['action'] for action in recent_actions)
+        user_counts = Counter(action['username'] for action in recent_actions)
+
+        # Формирование отчёта: строки идут потоком, без промежуточного списка
+        report = chain(
+            (
+                "📊 Статистика за последние 6 часов:",
+                f"Всего действий: {len(recent_actions)}",
+                f"Уникальных пользователей: {len(user_counts)}",
+                "Действия по типам:",
+            ),
+            (f"- {action}: {count}" for action, count in action_counts.items()),
+            ("Действия по пользователям:",),
+            (f"- {username}: {count}" for username, count in user_counts.items()),
+            ("Подробности:",),
+            (f"- [{action['timestamp']}] {action['username']}: {action['details']}" for action in recent_actions),
+        )
 
-        if not recent_actions:
+        # Отправка отчёта: длинный отчёт делится на сообщения в пределах лимита Telegram
+        sent = 0
+        for text in iter_message_chunks(report):
             context.bot.send_message(
-                chat_id=1250098712,
-                text="📊 Статистика за последние 6 часов: нет активности.",
+                chat_id=STATS_CHAT_ID,
+                text=text,
                 parse_mode=None
             )
-            logger.info("Статистика за последние 6 часов отсутствует")
-            return
-
-        # Подсчёт статистики
-        action_counts = defaultdict(int)
-        user_counts = defaultdict(int)
-        for action in recent_actions:
-            action_counts[action['action']] += 1
-            username = action.get('username', f"ID {action['user_id']}")  # Используем username или ID
-            user_counts[username] += 1
-
-        # Формирование отчёта
-        report = ["📊 Статистика за последние 6 часов:"]
-        report.append(f"Всего действий: {len(recent_actions)}")
-        report.append(f"Уникальных пользователей: {len(user_counts)}")
-        report.append("Действия по типам:")
-        for action, count in action_counts.items():
-            report.append(f"- {action}: {count}")
-        report.append("Действия по пользователям:")
-        for username, count in user_counts.items():
-            report.append(f"- {username}: {count}")
-        report.append("Подробности:")
-        for action in recent_actions:
-            username = action.get('username', f"ID {action['user_id']}")
-            report.append(f"- [{action['timestamp']}] {username}: {action['details']}")
-
-        # Отправка отчёта
-        context.bot.send_message(
-            chat_id=1250098712,
-            text="\n".join(report),
-            parse_mode=None
-        )
-        logger.info(f"Статистика отправлена пользователю 1250098712")
-
-        # Очистка старых записей
-        context.bot_data['user_actions'] = [action for action in actions if datetime.fromisoformat(action['timestamp']).timestamp() >= six_hours_ago]
-        logger.info(f"Статистика очищена, осталось {len(context.bot_data['user_actions'])} записей")
+            sent += 1
+        logger.info(f"Статистика отправлена в чат {STATS_CHAT_ID} ({sent} сообщ.)")
     except Exception as e:
-        logger.error(f"Ошибка при отправке статистики пользователю 1250098712: {str(e)}", exc_info=True)
-
-
+        logger.error(f"Ошибка при отправке статистики в чат {STATS_CHAT_ID}: {str(e)}", exc_info=True)
+
+
+# Ротация по размеру: user_actions.jsonl -> .1 -> .2 ... старше USER_ACTIONS_BACKUPS удаляется
+def rotate_user_actions():
+    for i in range(USER_ACTIONS_BACKUPS - 1, 0, -1):
+        backup = f"{USER_ACTIONS_FILE}.{i}"
+        if os.path.exists(backup):
+            os.replace(backup, f"{USER_ACTIONS_FILE}.{i + 1}")
+    os.replace(USER_ACTIONS_FILE, f"{USER_ACTIONS_FILE}.1")
+
+# Одна запись на пачку: одна запись в файл и одна проверка ротации. Ошибки ввода-вывода
+# не глушатся (в отличие от logging), чтобы неудачную пачку можно было повторить
+def write_user_actions(payload: str):
+    chunk = (payload + '\n').encode('utf-8')
+    with USER_ACTIONS_LOCK:
+        try:
+            size = os.path.getsize(USER_ACTIONS_FILE)
+        except FileNotFoundError:
+            size = 0
+        if size and size + len(chunk) > USER_ACTIONS_MAX_BYTES:
+            rotate_user_actions()
+        with open(USER_ACTIONS_FILE, 'ab') as f:
+            f.write(chunk)
+
+# Дописывание новых действий пользователей в USER_ACTIONS_FILE (фоновая задача)
+def flush_user_actions(context: CallbackContext):
+    actions = list(context.bot_data.get('user_actions', []))
+    last_flushed = context.bot_data.get('user_actions_flushed')
+    new_actions = []
+    for action in reversed(actions):
+        if action is last_flushed:
+            break
+        new_actions.append(action)
+    if not new_actions:
+        return
+    new_actions.reverse()
+    try:
+        write_user_actions('\n'.join(json_dumps(action).decode('utf-8') for action in new_actions))
+    except OSError as e:
+        # Отметка не сдвигается: пачка будет записана при следующем запуске задачи
+        logger.error(f"Ошибка записи {USER_ACTIONS_FILE}: {e}")
+        return
+    context.bot_data['user_actions_flushed'] = new_actions[-1]
+    logger.info(f"Записано {len(new_actions)} действий пользователей в {USER_ACTIONS_FILE}")
 
 def stats_command(update: Update, context: CallbackContext):
     # Ограничение доступа только для вашего Telegram ID
-    if update.effective_user.id != 1250098712:
+    if update.effective_user.id not in ADMIN_IDS:
         logger.info(f"Пользователь {update.effective_user.id} попытался использовать /stats, но доступ запрещён")
         update.message.reply_text(
             "❌ Доступ к команде /stats ограничен.",
@@ -2652,8 +3064,8 @@ def stats_command(update: Update, context: CallbackContext):
         )
         return
     logger.info(f"Пользователь ID {update.effective_user.id} вызвал команду /stats")
-    # Вызов функции отправки статистики
-    send_usage_stats(context)
+    # Отправка статистики в пуле потоков диспетчера, не блокируя обработку обновлений
+    context.dispatcher.run_async(send_usage_stats, context)
     update.message.reply_text(
         "📊 Статистика отправлена!",
         reply_markup=MAIN_MENU
@@ -2665,32 +3077,19 @@ def delete_answer(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     try:
-        user_display = context.user_data.get('user_display', f"ID {update.effective_user.id}")
-        logger.debug(f"Пользователь {user_display} вызвал delete_answer с callback_data: {query.data}")
+        user_display = context.user_data.get('user_display') or user_display_name(update.effective_user.id)
+        logger.debug("Пользователь %s вызвал delete_answer с callback_data: %s", user_display, query.data)
         message_ids = context.user_data.get('answer_message_ids', [])
         if not message_ids:
             logger.warning(f"Пользователь {user_display} попытался удалить сообщения, но answer_message_ids пуст")
             return ConversationHandler.END
         chat_id = query.message.chat_id
-        deleted_count = 0
-        for message_id in message_ids:
-            try:
-                context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-                logger.info(f"Пользователь {user_display} удалил сообщение {message_id} в чате {chat_id}")
-                deleted_count += 1
-            except Exception as e:
-                logger.debug(f"Не удалось удалить сообщение {message_id} в чате {chat_id}: {str(e)}")
+        deleted_count = delete_messages(context.bot, chat_id, message_ids)
         context.user_data['answer_message_ids'] = []
         context.user_data['current_question_id'] = None
         logger.info(f"Пользователь {user_display} успешно удалил {deleted_count} сообщений")
         # Запись действия с никнеймом
-        context.bot_data['user_actions'].append({
-            'user_id': update.effective_user.id,
-            'username': update.effective_user.username or f"ID {update.effective_user.id}",
-            'action': 'delete_answer',
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'details': f"Пользователь удалил {deleted_count} сообщений"
-        })
+        record_action(context, update.effective_user, 'delete_answer', f"Пользователь удалил {deleted_count} сообщений")
         context.user_data['conversation_state'] = 'DELETE_ANSWER'
         context.user_data['conversation_active'] = False
         return ConversationHandler.END